@@ -4,6 +4,7 @@ import torch.nn.functional as F
 
 import dgl
 import dgl.function as fn
+from dgl.ops import edge_softmax, u_mul_v, u_mul_e_sum
 import numpy as np
 
 """
@@ -55,11 +56,12 @@ def exp(field):
 """
 
 class MultiHeadAttentionLayer(nn.Module):
-    def __init__(self, in_dim, out_dim, num_heads, use_bias):
+    def __init__(self, in_dim, out_dim, num_heads, use_bias, fused=False):
         super().__init__()
         
         self.out_dim = out_dim
         self.num_heads = num_heads
+        self.fused = fused
         
         if use_bias:
             self.Q = nn.Linear(in_dim, out_dim * num_heads, bias=True)
@@ -93,6 +95,13 @@ class MultiHeadAttentionLayer(nn.Module):
         g.send_and_recv(eids, fn.src_mul_edge('V_h', 'score', 'V_h'), fn.sum('V_h', 'wV'))
         g.send_and_recv(eids, fn.copy_edge('score', 'score'), fn.sum('score', 'z'))
     
+    def propagate_attention_fused(self, g, Q_h, K_h, V_h, proj_e):
+        # the same attention with the built-in ops of dgl, one sddmm, the edge softmax and one spmm,
+        # the softmax has no 1e-6 in the normalizer
+        score = u_mul_v(g, K_h, Q_h) / np.sqrt(self.out_dim) * proj_e
+        attn = edge_softmax(g, score.sum(-1, keepdim=True).clamp(-5, 5))
+        return u_mul_e_sum(g, V_h, attn), score
+    
     def forward(self, g, h, e):
         Q_h = self.Q(h)
         K_h = self.K(h)
@@ -100,6 +109,9 @@ class MultiHeadAttentionLayer(nn.Module):
         proj_e = self.proj_e(e)
         # Reshaping into [num_nodes, num_heads, feat_dim] to 
         # get projections for multi-head attention
+        if self.fused:
+            shape = (-1, self.num_heads, self.out_dim)
+            return self.propagate_attention_fused(g, Q_h.view(shape), K_h.view(shape), V_h.view(shape), proj_e.view(shape))
         #print(g.ndata['feats'].shape, Q_h.shape, self.num_heads, self.out_dim)
         g.ndata['Q_h'] = Q_h.view(-1, self.num_heads, self.out_dim)
         g.ndata['K_h'] = K_h.view(-1, self.num_heads, self.out_dim)
@@ -120,7 +132,7 @@ class GraphTransformerLayer(nn.Module):
     """
         Param: 
     """
-    def __init__(self, in_dim, out_dim, num_heads, dropout=0.0, layer_norm=False, batch_norm=True, residual=True, use_bias=False):
+    def __init__(self, in_dim, out_dim, num_heads, dropout=0.0, layer_norm=False, batch_norm=True, residual=True, use_bias=False, fused=False):
         super().__init__()
 
         self.in_channels = in_dim
@@ -131,7 +143,7 @@ class GraphTransformerLayer(nn.Module):
         self.layer_norm = layer_norm     
         self.batch_norm = batch_norm
         
-        self.attention = MultiHeadAttentionLayer(in_dim, out_dim//num_heads, num_heads, use_bias)
+        self.attention = MultiHeadAttentionLayer(in_dim, out_dim//num_heads, num_heads, use_bias, fused)
         
         self.O_h = nn.Linear(out_dim, out_dim)
         self.O_e = nn.Linear(out_dim, out_dim)
@@ -4,6 +4,7 @@ from sklearn.metrics import mean_absolute_error
 from sklearn.metrics import r2_score
 import numpy as np
 import os
+from adj_store import load_adjacency
 from data import *
 
 
@@ -56,9 +57,7 @@ def prepare_data(config):
         train_index = np.load(config.data_path + 'train_index.npy', allow_pickle=True)
         test_index = np.load(config.data_path + 'test_index.npy', allow_pickle=True)
         print('Data is loaded.')
-    adj = [np.load(config.data_path + 'adjacency_house.npy'), np.load(config.data_path + 'adjacency_geo.npy')]
-    # not working
-    #adj = [np.load(config.data_path + 'adjacency_house.npz')['data'], np.load(config.data_path + 'adjacency_geo.npz')['data']]
+    adj = [load_adjacency(config.data_path + 'adjacency_house').toarray(0), load_adjacency(config.data_path + 'adjacency_geo').toarray(0)]
     print('adj: ' + str(adj[0].shape))
     print('features: ' + str(features.shape))
     print('labels: ' + str(labels.shape))
@@ -10,6 +10,7 @@ from sklearn.metrics import f1_score as sk_f1_score
 from utils import init_seed, _norm
 import copy
 import pandas as pd
+from adj_store import load_adjacency, BatchGraphs
 
 if __name__ == '__main__':
     init_seed(seed=777)
@@ -75,14 +76,15 @@ if __name__ == '__main__':
     A.append((edge_tmp,value_tmp))
     '''
     A = []
-    adj_matrix = np.load('dataset/{}.npy'.format("adjacency_house"))
+    adj_matrix = load_adjacency('dataset/{}'.format("adjacency_house"))
     #for i in range(adj_matrix.shape[0]):
-    edge_index = torch.from_numpy(np.vstack(adj_matrix.nonzero())).to(torch.long).to(device)
+    edge_index, edge_value = adj_matrix.edge_index(0)
+    edge_index = edge_index.to(device)
     # add target node
-    edge_value = torch.from_numpy(adj_matrix[adj_matrix.nonzero()]).to(torch.float).to(device)
+    edge_value = edge_value.to(device)
     #print(edge_index.shape, edge_value.shape)
     A.append((edge_index, edge_value))
-    num_nodes = adj_matrix.shape[0]
+    num_nodes = adj_matrix.num_nodes
     #exit()
     args.num_nodes = num_nodes
     # add self-loops and normalize if needed
@@ -117,6 +119,9 @@ if __name__ == '__main__':
     node_features = torch.from_numpy(node_features).type(torch.FloatTensor).to(device)
     train_node_features = node_features[nids[0]]
     valid_node_features = node_features[nids[1]]
+    # edges of the batches, sliced once instead of in every epoch
+    train_graphs = BatchGraphs.edge_slices(A, len(train_node_features), args.batch_size)
+    valid_graphs = BatchGraphs.edge_slices(A, len(valid_node_features), args.batch_size)
     #test_node_features = node_features[nids[2]]
 
     runs = args.runs
@@ -171,13 +176,11 @@ if __name__ == '__main__':
                 num_batches = len(train_node_features)//batch_size
                 optimizer.zero_grad()
                 # take a batch of adjecency matrix
-                a = []
-                for i in range(len(A)):
-                    a.append((A[i][0][:, batch:batch+batch_size], A[i][1][batch:batch+batch_size]))
+                a = train_graphs[batch]
                 num_nodes = a[0][0].shape[1]
                 #print(len(a), a[0][0].shape, a[0][1].shape)
                 if args.model == 'FastGTN':
-                    loss,train_mse,y_train,W = model(a, train_node_features[batch:batch+batch_size], train_target[batch:batch+batch_size], epoch=i)
+                    loss,train_mse,y_train,W = model(a, train_node_features[batch:batch+batch_size], train_target[batch:batch+batch_size], epoch=epoch)
                 else:
                     loss,train_mse,y_train,W = model(a, train_node_features[batch:batch+batch_size], train_target[batch:batch+batch_size])
                 loss.backward()
@@ -192,9 +195,7 @@ if __name__ == '__main__':
                 batch_size = min(args.batch_size, len(valid_node_features)-batch)
                 num_batches = len(valid_node_features)//batch_size
                 # take a batch of adjecency matrix
-                a = []
-                for i in range(len(A)):
-                    a.append((A[i][0][:, batch:batch+batch_size], A[i][1][batch:batch+batch_size]))
+                a = valid_graphs[batch]
                 with torch.no_grad():
                     if args.model == 'FastGTN':
                         val_loss, val_mse, y_valid,_ = model.forward(a, valid_node_features[batch:batch+batch_size], valid_target[batch:batch+batch_size], epoch=epoch)
@@ -211,7 +212,7 @@ if __name__ == '__main__':
                     num_batches = len(test_node_features)//batch_size
                     with torch.no_grad():
                         if args.model == 'FastGTN':
-                            test_loss, y_test,W = model.forward(A, test_node_features[batch:batch+batch_size], test_target[batch:batch+batch_size], epoch=i)
+                            test_loss, y_test,W = model.forward(A, test_node_features[batch:batch+batch_size], test_target[batch:batch+batch_size], epoch=epoch)
                         else:
                             test_loss, y_test,W = model.forward(A, test_node_features[batch:batch+batch_size], test_target[batch:batch+batch_size])
                     avg_test_loss += test_loss.detach().cpu().numpy() / num_batches
@@ -11,6 +11,7 @@ from sklearn.metrics import f1_score as sk_f1_score
 from utils import init_seed, _norm
 import copy
 import pandas as pd
+from adj_store import load_adjacency
 #from sklearn.externals import joblib 
 import joblib
 import os
@@ -65,14 +66,15 @@ if __name__ == '__main__':
     num_layers = args.num_layers
 
     A = []
-    adj_matrix = np.load('data/{}.npy'.format("adjacency_house_yearly"))
+    adj_matrix = load_adjacency('data/{}'.format("adjacency_house_yearly"))
     #for i in range(adj_matrix.shape[0]):
-    edge_index = torch.from_numpy(np.vstack(adj_matrix.nonzero())).to(torch.long).to(device)
+    edge_index, edge_value = adj_matrix.edge_index(0)
+    edge_index = edge_index.to(device)
     # add target node
-    edge_value = torch.from_numpy(adj_matrix[adj_matrix.nonzero()]).to(torch.float).to(device)
+    edge_value = edge_value.to(device)
     #print(edge_index.shape, edge_value.shape)
     A.append((edge_index, edge_value))
-    num_nodes = adj_matrix.shape[0]
+    num_nodes = adj_matrix.num_nodes
     #exit()
     args.num_nodes = num_nodes
     # add self-loops and normalize if needed
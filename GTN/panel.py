@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+
+"""
+Fill the gaps of the house price panel, so that every house has a row in every
+period. A missing (period, house) pair is filled with the first row of the house
+in the dataframe, with the period columns and the price replaced. The pairs are
+found by reindexing on the cartesian product of the periods and the houses
+instead of appending the rows one by one. Every group of periods (a year) is
+filled on its own, optionally in a process pool.
+"""
+
+
+def _fill_shard(df, template, periods, fill, hid):
+    '''
+    df: rows of one group of periods
+    template: first row of every house, indexed by house
+    '''
+    present = df[periods].drop_duplicates()
+    houses = template.index
+    full = present.loc[present.index.repeat(len(houses))].reset_index(drop=True)
+    full[hid] = np.tile(houses.values, len(present))
+    have = pd.MultiIndex.from_frame(df[periods + [hid]])
+    missing = full[~pd.MultiIndex.from_frame(full).isin(have)].reset_index(drop=True)
+    rows = template.loc[missing[hid]].reset_index()
+    for c in periods:
+        rows[c] = missing[c].values
+    if fill == 'mean':
+        # average price of the period, Series.mean sums like the loop it replaces
+        avg_price = df.groupby(periods)['price'].agg(lambda price: price.mean())
+        rows['price'] = avg_price.reindex(pd.MultiIndex.from_frame(missing[periods])).values
+    elif fill == 'house_mean':
+        # average price of the house in the group, or of the group if the house has no sale in it
+        house_price = df.groupby(hid)['price'].mean()
+        rows['price'] = house_price.reindex(missing[hid]).fillna(df['price'].mean()).values
+    elif fill != 'first':
+        rows['price'] = fill
+    return pd.concat((df, rows[df.columns]), ignore_index=True)
+
+
+def fill_gaps(df, periods, fill='mean', hid='house', group=None, processes=1):
+    '''
+    df: dataframe of sales with the period columns, hid and price
+    periods: columns of a period, e.g. ['year'] or ['year', 'month']. Only the
+        periods that have sales are filled
+    fill: price of a filled row, 'mean' of the period, 'house_mean' of the house
+        in the group, 'first' price of the house, or a number
+    group: columns that split the panel into shards, by default periods[:1]
+    processes: number of processes filling the shards
+    return: dataframe with one row for every period and house, sorted by period and house
+    '''
+    periods = list(periods)
+    group = list(group) if group is not None else periods[:1]
+    # the row that is copied for a missing house is its first row in df
+    template = df.drop_duplicates(subset=[hid], keep='first').set_index(hid)
+    shards = [(shard, template, periods, fill, hid) for _, shard in df.groupby(group, sort=True)]
+    if processes > 1:
+        with Pool(processes) as pool:
+            filled = pool.starmap(_fill_shard, shards)
+    else:
+        filled = [_fill_shard(*shard) for shard in shards]
+    df = pd.concat(filled, ignore_index=True)
+    return df.sort_values(by=periods + [hid], kind='stable').reset_index(drop=True)
@@ -1,53 +1,16 @@
 import os
 from time import time
-import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from adj_build import build_dice
+from panel import fill_gaps
 import argparse
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import MinMaxScaler
 #from sklearn.externals import joblib 
 import time
 
-def construct_graph_from_df(df, G=None, hid='house'):
-    '''
-    df: dataframe containing the data
-    G: networkx graph to which the data is to be added
-    '''
-    if G is None:
-        G = nx.Graph()
-    l = list(df.columns)
-    done_house = []
-    l.remove(hid)
-    for _, row in df.iterrows():
-        if row[hid] in done_house:
-            continue
-        G.add_node(row[hid])
-        done_house.append(row[hid])
-        for col in l:
-            G.add_node(row[col])
-            G.add_edge(row[hid], row[col])
-    return G
-
-# create adjacency matrix following the equaation in paper
-# https://arxiv.org/abs/2008.05880
-def create_adj(G, id_list):
-    '''
-    G: networkx graph for the meta path
-    id_list: list of ids for which adjacency matrix is to be created
-    '''
-    adj = np.zeros((len(id_list), len(id_list)), dtype=np.float64)
-    for i, h1 in enumerate(id_list):
-        for j, h2 in enumerate(id_list):
-            l1 = [t[1] for t in list(G.edges(h1))]
-            l2 = [t[1] for t in list(G.edges(h2))]
-            den = len(l1) + len(l2)
-            num = 2 * len(list(set(l1) & set(l2)))
-            similarity = num / den
-            adj[i][j] = similarity
-    return adj
-
 def apply_PC(A):
     '''
     A: adjacency matrix
@@ -62,6 +25,11 @@ if __name__ == '__main__':
     parser.add_argument("--data_path" , type=str, default='./dataset/dataset_realestate.csv')
     parser.add_argument("--create_adj", type=int, default=1)
     parser.add_argument("--fill_gaps", type=int, default=1)
+    # number of processes filling the gaps, one year at a time, and building the adjacency
+    parser.add_argument("--processes", type=int, default=1)
+    # similarity join, only keep similarities of at least threshold and the top_k of every house
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--top_k", type=int, default=None)
     args = parser.parse_args()
 
     df = pd.read_csv(args.data_path, encoding = 'unicode_escape', index_col=False)
@@ -91,43 +59,9 @@ if __name__ == '__main__':
     df = df.sort_values(by=['year', 'month', 'house'])
     df = df.reset_index(drop=True)
     if args.fill_gaps:
-        
-        # if house is not in the month, fill the missing value with price 0
-        for i in list(set(df.year)):
-            df_year = df[df['year'] == i]
-            # find average price of the year
-            avg_price = df_year.price.mean()
-            houses_year = set(df_year.house)
-            for j in list(set(df_year.month)):
-                df_month = df_year[df_year['month'] == j]
-                houses = list(set(df_month.house))
-                next_year = df[df.year == i+1] if i < max(df.year) else None
-                for h in all_houses:
-                    if h not in houses:
-                        row = df[df['house'] == h].iloc[0].copy()
-                        # op1: fill with average price of the year
-                        # if house is not in the month, fill with other month's price
-                        if h in houses_year:
-                            row.price = df_year[df_year['house'] == h].price.mean()
-                        else:
-                            row.price = avg_price
-                        #row.house = h
-                        
-                        # op2: fill with 0
-                        #row.price = 0
-                        row.year = i
-                        row.month = j
-                        
-                        df_year = df_year.append(row, ignore_index=True)
-                        
-                        # op3: fill with price of the same hosue in previous month      
-            df_year = df_year.sort_values(by=['house'])
-            df_year = df_year.reset_index(drop=True)
-            if i == list(set(df.year))[0]:
-                df_new = df_year
-            else:
-                df_new = pd.concat((df_new, df_year))
-        df = df_new
+        # if house is not in the month, fill the missing value with the average price
+        # of the house in the year, or the average price of the year
+        df = fill_gaps(df, ['year', 'month'], fill='house_mean', processes=args.processes)
         # sort houses by year and house id
         df = df.sort_values(by=['year', 'month', 'house'])
         
@@ -166,7 +100,7 @@ if __name__ == '__main__':
                 df_new = pd.concat([df_new, df_year])
             print('year {} done, time: {}'.format(i, time.time()-start))
         '''
-        df = df_new.sort_values(by=['year', 'month', 'house']).reset_index(drop=True)
+        df = df.sort_values(by=['year', 'month', 'house']).reset_index(drop=True)
     # create meta path and construct graph
     if args.create_adj:
         house_meta = ['house', 'area_index', 'households',
@@ -183,11 +117,13 @@ if __name__ == '__main__':
         df_h = df_single[house_meta]
         #print(df_h.shape)
         df_g = df_single[geo_meta]
-        Gh = construct_graph_from_df(df_h)
-        Gg = construct_graph_from_df(df_g)
         # Create adjacency matrix for each meta path
-        Ah = create_adj(Gh, df_single.house.tolist())
-        Ag = create_adj(Gg, df_single.house.tolist())
+        Ah = build_dice('./dataset/adjacency_house', [df_h], df_single.house.tolist(), names=['house'],
+                        node_ids=df_single.house.values, threshold=args.threshold,
+                        top_k=args.top_k, processes=args.processes)[0]
+        Ag = build_dice('./dataset/adjacency_geo', [df_g], df_single.house.tolist(), names=['geo'],
+                        node_ids=df_single.house.values, threshold=args.threshold,
+                        top_k=args.top_k, processes=args.processes)[0]
         # duplicate the adjacency matrix for each year
         #Ah = np.tile(Ah, (len(list(set(df.year))), len(list(set(df.year)))))
         #Ag = np.tile(Ag, (len(list(set(df.year))), len(list(set(df.year)))))
@@ -198,11 +134,6 @@ if __name__ == '__main__':
         # there is a bug again ...
         #Ah = apply_PC(Ah)
         #Ag = apply_PC(Ag)
-        np.save('./dataset/adjacency_house.npy', Ah)
-        np.save('./dataset/adjacency_geo.npy', Ag)
-        # It is better to save the adjacency matrix in sparse format, but it is not working
-        #sparse.save_npz('./dataset/adjacency_house.npz', sparse.csr_matrix(Ah))
-        #sparse.save_npz('./dataset/adjacency_geo.npz', sparse.csr_matrix(Ag))
 
     # prepare data for training using one-hot encoding
     print(df.shape)
@@ -5,6 +5,8 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from adj_store import save_adjacency
+from adjacency import normalize_rows
 import matplotlib.pyplot as plt
 import argparse
 from sklearn.decomposition import PCA
@@ -14,16 +16,26 @@ import joblib
 
 
 
+def knn_adj(values, id_list):
+    """
+    values: (N, K) value of every sample for each of its K nearest neighbours
+    id_list: (N, K) index of the neighbours
+    return: (N, N) csr matrix with values[i, k] at (i, id_list[i, k])
+    """
+    values = np.asarray(values, dtype=np.float64)
+    id_list = np.asarray(id_list, dtype=np.int64).reshape(values.shape)
+    n = len(values)
+    rows = np.repeat(np.arange(n), values.shape[1])
+    return sparse.csr_matrix((values.ravel(), (rows, id_list.ravel())), shape=(n, n))
+
+
 def geo_adj(distance, id_list):
-    adj = np.zeros((len(distance), len(distance)), dtype=np.float64)
     # put the distance value for each id and id_list instance
-    for i in range(len(distance)):
-        adj[i, id_list] = distance[i]
+    adj = knn_adj(distance, id_list)
     # normalize the adjacency matrix
-    adj = adj / adj.sum(axis=1, keepdims=True)
-    return adj    
+    return normalize_rows(adj)
+
 
-    
 
 def create_euc_adj(distance, id_list, sigma):
     """
@@ -32,13 +44,11 @@ def create_euc_adj(distance, id_list, sigma):
     with respect to the distance
     the range of sigma is [0, 1]
     """
-    adj = np.zeros((len(distance), len(distance)), dtype=np.float64)
-    p = np.exp(-distance  * (sigma**2/2))
+    p = np.exp(-np.asarray(distance)  * (sigma**2/2))
     # put the distance value for each id and id_list instance
-    for i in range(len(distance)):
-        adj[i, id_list] = p[i]
+    adj = knn_adj(p, id_list)
     # normalize the adjacency matrix
-    #adj = adj / adj.sum(axis=1, keepdims=True)
+    #adj = normalize_rows(adj)
     # let's avoid normalization
     return adj
 
@@ -76,18 +86,12 @@ if __name__ == '__main__':
 
         A_geo = geo_adj(dist_geo, id_list_geo)
         A_eucli = create_euc_adj(dist_eucli, id_list_eucli, args.sigma)
-        # combine the adjacency matrix
-        # add dimension at the beginning
-        A_geo = A_geo[np.newaxis, :, :]
-        A_eucli = A_eucli[np.newaxis, :, :]
-        A = np.concatenate((A_geo, A_eucli), axis=0)
+        # one sparse matrix per meta path
+        A = [A_geo, A_eucli]
         
-        print("The true shape of adjacency matrix for house meta path is {}".format(A.shape)) 
+        print("The true shape of adjacency matrix for house meta path is {}".format((len(A),) + A_geo.shape)) 
 
-        np.save('./data/adjacency.npy', A)
-        # It is better to save the adjacency matrix in sparse format, but it is not working
-        #sparse.save_npz('./data/adjacency_house.npz', sparse.csr_matrix(Ah))
-        #sparse.save_npz('./data/adjacency_geo.npz', sparse.csr_matrix(Ag))
+        save_adjacency('./data/adjacency', A, names=['geo', 'eucli'])
 
 
     scaler = MinMaxScaler(feature_range=(-1, 1))
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import atexit
+import signal
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+
+"""
+Buffered metrics log of a training run.
+
+Every call of RunLog.log is one record, a json object on its own line of the
+.jsonl file of the run:
+
+    {"time": 1686130000.5, "elapsed": 12.3, "phase": "train", "step": 4, "seconds": 2.1, "loss": 0.01}
+
+time is the unix time of the record, elapsed the seconds since the log was
+opened and seconds the wall clock of the phase measured by RunLog.timer. The
+records are kept in memory and appended to the file every flush_every records
+or flush_secs seconds, with one open and one write. A flush writes whole lines
+only and the log is flushed at exit, also on Ctrl + C or SIGTERM, so a killed
+run loses at most the records of the last interval and never leaves a broken
+file; read_log skips a last line cut by a crash of the machine.
+"""
+
+_OPEN = []
+
+
+def _flush_all():
+    for log in list(_OPEN):
+        log.close()
+
+
+def _terminate(signum, frame):
+    # SystemExit runs the atexit handlers, the default action of SIGTERM does not
+    raise SystemExit(128 + signum)
+
+
+atexit.register(_flush_all)
+if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+    signal.signal(signal.SIGTERM, _terminate)
+
+
+def _value(v):
+    '''
+    json value of a metric, tensors and numpy numbers become python numbers
+    '''
+    if hasattr(v, 'detach'):
+        v = v.detach().cpu().numpy()
+    if isinstance(v, np.ndarray):
+        return v.item() if v.size == 1 else v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, (list, tuple)):
+        return [_value(x) for x in v]
+    if isinstance(v, dict):
+        return {k: _value(x) for k, x in v.items()}
+    return v
+
+
+class RunLog:
+    def __init__(self, path, flush_every=100, flush_secs=60):
+        '''
+        path: .jsonl file of the run, records are appended to an existing file
+        flush_every: number of records kept before they are written
+        flush_secs: seconds after which the kept records are written
+        '''
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.start = time.time()
+        self.last_flush = time.time()
+        self.records = []
+        self.seconds = {}
+        _OPEN.append(self)
+
+    def log(self, phase, step=None, **values):
+        '''
+        phase: e.g. 'train', 'valid' or 'test'
+        step: epoch or iteration of the record
+        values: metrics of the record
+        '''
+        now = time.time()
+        record = {'time': now, 'elapsed': now - self.start, 'phase': phase, 'step': _value(step)}
+        if phase in self.seconds:
+            record['seconds'] = self.seconds.pop(phase)
+        record.update({k: _value(v) for k, v in values.items()})
+        self.records.append(json.dumps(record))
+        if len(self.records) >= self.flush_every or now - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    @contextmanager
+    def timer(self, phase):
+        '''
+        adds the wall clock of the block to the next record of phase
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] = self.seconds.get(phase, 0) + time.perf_counter() - start
+
+    def flush(self):
+        if self.records:
+            with open(self.path, 'a') as f:
+                f.write(''.join(r + '\n' for r in self.records))
+            self.records = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        if self in _OPEN:
+            _OPEN.remove(self)
+
+
+def read_log(path, phase=None):
+    '''
+    return: list of the records of the run, of one phase if phase is given
+    '''
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a run that was cut while writing
+                continue
+            if phase is None or record['phase'] == phase:
+                records.append(record)
+    return records
@@ -6,15 +6,18 @@ import os
 import numpy as np
 import csv
 import dgl
-from dgl.data.utils import load_graphs
+from dgl.data.utils import load_graphs, save_graphs
 from scipy import sparse as sp
+from scipy.sparse.linalg import eigsh
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import networkx as nx
 import hashlib
 import pandas as pd
+from adj_store import load_adjacency
 
 class RealEstateDGL(torch.utils.data.Dataset):
-    def __init__(self, data_dir, adjacency_names, X, y, train=True):
+    def __init__(self, data_dir, adjacency_names, X, y, train=True, minimum_weight=0.1):
         """For now, we only support the full dataset as training data."""
         self.data_dir = data_dir
         self.dataset_name = 'RealEstate'
@@ -29,12 +32,8 @@ class RealEstateDGL(torch.utils.data.Dataset):
             self.df = self.df[-5000:]
             self.labels = self.labels[-5000:]
         self.number_of_nodes = self.df.shape[0]
-        # check if saved graph exists
-        if os.path.exists(os.path.join(data_dir, 'graph.bin')):
-            self.graph, _ = load_graphs(os.path.join(data_dir, 'graph.bin'))
-            self.meta_size = self.graph.edata['weight_1'].shape[1]
-        else:
-            self._prepare_graphs(adjacency_names, self.df)
+        self.minimum_weight = minimum_weight
+        self._prepare_graphs(adjacency_names, self.df)
     
     def _prepare_graphs(self, adjacency_names, node_features):
         graph = None
@@ -104,48 +103,33 @@ class RealEstateDGL(torch.utils.data.Dataset):
             # Append the subgraph to the list
             self.graph_list.append(subg)
             '''
-        self.graph_list = []
         name = 'adjacency.npy'
-        A = np.load(os.path.join(self.data_dir, name))
-        A = A[0]
+        # csr matrix of the first meta path, the rows are never made dense
+        adjacency = load_adjacency(os.path.join(self.data_dir, name))
+        limit = node_features.shape[0]
+        # ego graphs of an earlier run with the same adjacency, threshold and data
+        path = self.cache_path = self._cache_path(adjacency, limit, 'train' if self.train else 'test')
+        if os.path.exists(path):
+            self.graph_list, label_dict = load_graphs(path)
+            self.labels = label_dict['labels'].numpy()
+            self.number_of_nodes = len(self.graph_list)
+            return
+        A = adjacency[0]
         if self.train:
             A = A[:self.df.shape[0], :self.df.shape[0]]
         else:
             A = A[-self.df.shape[0]:, -self.df.shape[0]:]
-        limit = node_features.shape[0]
         A = A[:limit, :limit]
         self.number_of_nodes = A.shape[0]
-        # experimntal parameters
-        minimum_weight = 0.1
-        #feature_limit = 100
-        for i in range(self.number_of_nodes):
-            src, dst = np.nonzero(A)
-            # Get the incoming edges and their weights for the current node given A
-            chosen = np.where(src == i)
-            src = src[chosen]
-            dst = dst[chosen]
-            weight = A[src, dst]
-            mask = weight >= minimum_weight
-            src = src[mask]
-            dst = dst[mask]
-            weight = weight[mask]
-            # limit to smaller graphs
-            #scr = src[:limit]
-            #dst = dst[:limit]
-            #weight = weight[:limit]
-            # rename dst items from 1 to len(dst)
-            src_ = torch.arange(0, len(src))
-            dst_ = torch.arange(0, len(dst))
-            g = dgl.DGLGraph((src_, dst_))
-            #print(A.shape, src.shape, dst.shape, src_.shape, dst_.shape)
-            g.edata['weight'] = torch.tensor(A[src_, dst_])
-            #print(g.edata['weight'].shape, node_features[dst].shape, node_features[src_].shape)
-            #print(A.shape, node_features.shape)
-            g.ndata['feats'] = torch.tensor(node_features[dst])#[:,:feature_limit])
-            #print("src", src.shape,"feats", g.ndata['feats'].shape)
-            self.graph_list.append(g)
-            #if i == 5:
-            #   break
+        self.graph_list = ego_graphs(A, node_features, self.minimum_weight)
+        save_graphs(path, self.graph_list, {'labels': torch.tensor(self.labels)})
+
+    def _cache_path(self, adjacency, limit, part=''):
+        h = hashlib.sha1()
+        h.update('{}_{}_{}_{}'.format(adjacency.fingerprint, self.minimum_weight, limit, part).encode())
+        h.update(np.ascontiguousarray(self.df).tobytes())
+        h.update(np.ascontiguousarray(self.labels).tobytes())
+        return os.path.join(self.data_dir, 'ego_graphs_{}.bin'.format(h.hexdigest()))
         
     def __len__(self):
         """Return the number of graphs in the dataset."""
@@ -180,18 +164,55 @@ class RealEstateDGL(torch.utils.data.Dataset):
         # this function will be called only if full_graph flag is True
         self.graph_list = [make_full_graph(g) for g in self.graph_list]    
     
-    def _add_laplacian_positional_encodings(self, pos_enc_dim):
+    def _add_laplacian_positional_encodings(self, pos_enc_dim, processes=None):
         
         # Graph positional encoding v/ Laplacian eigenvectors
-        self.graph_list = [laplacian_positional_encoding(g, pos_enc_dim) for g in self.graph_list]
+        # saved next to the cached graph list, for the same graphs and pos_enc_dim
+        h = hashlib.sha1()
+        src, dst = dgl.batch(self.graph_list).edges()
+        h.update(src.numpy().tobytes())
+        h.update(dst.numpy().tobytes())
+        path = '{}_lap_pos_enc_{}_{}.pt'.format(self.cache_path[:-len('.bin')], pos_enc_dim, h.hexdigest()[:16])
+        if os.path.exists(path):
+            pos_enc = torch.split(torch.load(path), [g.number_of_nodes() for g in self.graph_list])
+        else:
+            pos_enc = laplacian_positional_encodings(self.graph_list, pos_enc_dim,
+                                                     processes=processes or os.cpu_count())
+            torch.save(torch.cat(pos_enc), path)
+        for g, p in zip(self.graph_list, pos_enc):
+            g.ndata['lap_pos_enc'] = p
 
     def _add_wl_positional_encodings(self):
-        # WL positional encoding from Graph-Bert, Zhang et al 2020.
-        self.graph_list = [wl_positional_encoding(g) for g in self.graph_list]
+        # WL positional encoding from Graph-Bert, Zhang et al 2020, of all graphs at once
+        for g, p in zip(self.graph_list, wl_positional_encodings(self.graph_list)):
+            g.ndata['wl_pos_enc'] = p
 
         
 
 
+def ego_graphs(A, node_features, minimum_weight):
+    """
+        Ego graph of every row of the csr matrix A, the nodes are the columns of
+        the row with a weight >= minimum_weight.
+        The threshold is applied on the csr data and all ego graphs are built
+        as one batched graph in one pass, then split with dgl.unbatch
+    """
+    A = sp.csr_matrix(A)
+    keep = A.data >= minimum_weight
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    counts = kept[A.indptr[1:]] - kept[A.indptr[:-1]]
+    dst = A.indices[keep]
+    # id of every node inside its ego graph
+    local = np.arange(len(dst)) - np.repeat(np.cumsum(counts) - counts, counts)
+    nodes = torch.arange(len(dst))
+    g = dgl.graph((nodes, nodes), num_nodes=len(dst))
+    g.edata['weight'] = torch.tensor(A.diagonal()[local])
+    g.ndata['feats'] = torch.tensor(node_features[dst])
+    g.set_batch_num_nodes(torch.tensor(counts))
+    g.set_batch_num_edges(torch.tensor(counts))
+    return dgl.unbatch(g)
+
+
 def self_loop(g):
     """
         Utility function only, to be used only when necessary as per user self_loop flag
@@ -243,24 +264,140 @@ def make_full_graph(g):
 
 
 
-def laplacian_positional_encoding(g, pos_enc_dim):
+def normalized_laplacian(g):
     """
-        Graph positional encoding v/ Laplacian eigenvectors
+        Symmetric normalized Laplacian of g as a csr matrix
     """
-
-    # Laplacian
     A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
     N = sp.diags(dgl.backend.asnumpy(g.in_degrees()).clip(1) ** -0.5, dtype=float)
-    L = sp.eye(g.number_of_nodes()) - N * A * N
+    return sp.csr_matrix(sp.eye(g.number_of_nodes()) - N * A * N)
 
-    # Eigenvectors with numpy
-    EigVal, EigVec = np.linalg.eig(L.toarray())
-    idx = EigVal.argsort() # increasing order
-    EigVal, EigVec = EigVal[idx], np.real(EigVec[:,idx])
-    g.ndata['lap_pos_enc'] = torch.from_numpy(EigVec[:,1:pos_enc_dim+1]).float() 
-    
+
+def _lap_eigvecs(laplacians, pos_enc_dim, sparse_above):
+    """
+        Eigenvectors 1..pos_enc_dim of laplacians of the same size, in
+        increasing order of the eigenvalues.
+        Up to sparse_above nodes the laplacians are solved with one batched
+        eigh, larger ones one by one with the sparse eigsh. Graphs with less
+        than pos_enc_dim + 1 nodes are padded with zeros.
+    """
+    n = laplacians[0].shape[0]
+    k = min(pos_enc_dim + 1, n)
+    if n > sparse_above and k < n:
+        vecs = []
+        for L in laplacians:
+            L = (L + L.T) / 2
+            # the spectrum is in [0, 2], the largest eigenvalues of 2I - L are the smallest of L
+            _, vec = eigsh(2 * sp.eye(n) - L, k=k, which='LA', v0=np.random.RandomState(0).rand(n))
+            vecs.append(vec[:, ::-1])
+        vecs = np.stack(vecs)
+    else:
+        L = np.stack([L.toarray() for L in laplacians])
+        _, vecs = np.linalg.eigh((L + L.transpose(0, 2, 1)) / 2)
+    vecs = vecs[:, :, 1:pos_enc_dim + 1]
+    if vecs.shape[2] < pos_enc_dim:
+        vecs = np.pad(vecs, ((0, 0), (0, 0), (0, pos_enc_dim - vecs.shape[2])))
+    return vecs.astype(np.float32)
+
+
+def laplacian_positional_encodings(graphs, pos_enc_dim, sparse_above=256, processes=1, chunk_size=2 ** 24):
+    """
+        Laplacian eigenvectors of every graph, a (nodes, pos_enc_dim) tensor per graph.
+        Graphs of the same size are grouped into chunks of about chunk_size
+        matrix entries and the chunks are solved in processes worker processes.
+    """
+    laplacians = [normalized_laplacian(g) for g in graphs]
+    sizes = {}
+    for i, L in enumerate(laplacians):
+        sizes.setdefault(L.shape[0], []).append(i)
+    chunks = []
+    for n, index in sizes.items():
+        step = max(1, chunk_size // max(n * n, 1))
+        chunks += [index[s:s + step] for s in range(0, len(index), step)]
+    args = [([laplacians[i] for i in chunk], pos_enc_dim, sparse_above) for chunk in chunks]
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_lap_eigvecs, *zip(*args)))
+    else:
+        results = [_lap_eigvecs(*a) for a in args]
+    pos_enc = [None] * len(graphs)
+    for chunk, vecs in zip(chunks, results):
+        for i, vec in zip(chunk, vecs):
+            pos_enc[i] = torch.from_numpy(vec)
+    return pos_enc
+
+
+def laplacian_positional_encoding(g, pos_enc_dim):
+    """
+        Graph positional encoding v/ Laplacian eigenvectors
+    """
+    g.ndata['lap_pos_enc'] = laplacian_positional_encodings([g], pos_enc_dim)[0]
     return g
 
+def _colour_hashes(signatures):
+    """
+        md5 of the colour string of every signature row [colour, neighbour colours, -1 padding],
+        the string the WL encoding of Graph-Bert hashes
+    """
+    hashes = []
+    for row in signatures:
+        neighbours = row[1:][row[1:] >= 0]
+        color_string_list = [str(row[0])] + sorted([str(color) for color in neighbours])
+        hashes.append(hashlib.md5("_".join(color_string_list).encode()).hexdigest())
+    return np.array(hashes)
+
+
+def wl_colours(src, dst, graph_ids, max_iter=2):
+    """
+        Weisfeiler-Lehman colours of the nodes of a disjoint union of graphs,
+        the colours of wl_positional_encoding for every graph.
+        src, dst: edges of the union, taken as undirected
+        graph_ids: graph of every node, non decreasing
+        A colour is the rank of the md5 of the node colour and the sorted colours
+        of its neighbours among the hashes of its graph. The neighbour colours
+        are sorted per node on the csr neighbours and the signatures are
+        relabelled with np.unique, so md5 is computed once per distinct signature.
+    """
+    graph_ids = np.asarray(graph_ids, dtype=np.int64)
+    n = len(graph_ids)
+    # undirected csr neighbours without duplicates
+    pairs = np.unique(np.concatenate((np.stack((src, dst), 1), np.stack((dst, src), 1))).astype(np.int64), axis=0)
+    rows, cols = pairs[:, 0], pairs[:, 1]
+    degree = np.bincount(rows, minlength=n)
+    indptr = np.concatenate(([0], np.cumsum(degree)))
+    position = np.arange(len(rows)) - indptr[rows]
+    colours = np.ones(n, dtype=np.int64)
+    for iteration in range(1, max_iter + 1):
+        # neighbour colours sorted within every row, padded with -1
+        order = np.lexsort((colours[cols], rows))
+        signatures = np.full((n, 1 + degree.max(initial=0)), -1, dtype=np.int64)
+        signatures[:, 0] = colours
+        signatures[rows, 1 + position] = colours[cols][order]
+        keys, inverse = np.unique(signatures, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        hashes = _colour_hashes(keys)
+        # rank of the hash of every node signature among the hashes of its graph
+        nodes, hash_index = np.unique(np.stack((graph_ids, np.unique(hashes, return_inverse=True)[1].reshape(-1)[inverse]), 1),
+                                      axis=0, return_inverse=True)
+        first = np.searchsorted(nodes[:, 0], nodes[:, 0])
+        new_colours = (np.arange(len(nodes)) - first + 1)[hash_index.reshape(-1)]
+        if np.array_equal(colours, new_colours) or iteration == max_iter:
+            break
+        colours = new_colours
+    return colours
+
+
+def wl_positional_encodings(graphs, max_iter=2):
+    """
+        WL positional encoding of every graph, computed on the batched graph
+    """
+    g = dgl.batch(graphs)
+    sizes = dgl.backend.asnumpy(g.batch_num_nodes())
+    src, dst = g.edges()
+    colours = wl_colours(src.numpy(), dst.numpy(), np.repeat(np.arange(len(sizes)), sizes), max_iter)
+    return list(torch.split(torch.from_numpy(colours), sizes.tolist()))
+
+
 def wl_positional_encoding(g):
     """
         WL-based absolute positional embedding 
@@ -270,50 +407,5 @@ def wl_positional_encoding(g):
         Zhang, Jiawei and Zhang, Haopeng and Xia, Congying and Sun, Li, 2020
         https://github.com/jwzhanggy/Graph-Bert
     """
-    max_iter = 2
-    node_color_dict = {}
-    node_neighbor_dict = {}
-
-    edge_list = torch.nonzero(g.adj().to_dense() != 0, as_tuple=False).numpy()
-    node_list = g.nodes().numpy()
-
-    # setting init
-    for node in node_list:
-        node_color_dict[node] = 1
-        node_neighbor_dict[node] = {}
-
-    for pair in edge_list:
-        u1, u2 = pair
-        if u1 not in node_neighbor_dict:
-            node_neighbor_dict[u1] = {}
-        if u2 not in node_neighbor_dict:
-            node_neighbor_dict[u2] = {}
-        node_neighbor_dict[u1][u2] = 1
-        node_neighbor_dict[u2][u1] = 1
-
-
-    # WL recursion
-    iteration_count = 1
-    exit_flag = False
-    while not exit_flag:
-        new_color_dict = {}
-        for node in node_list:
-            neighbors = node_neighbor_dict[node]
-            neighbor_color_list = [node_color_dict[neb] for neb in neighbors]
-            color_string_list = [str(node_color_dict[node])] + sorted([str(color) for color in neighbor_color_list])
-            color_string = "_".join(color_string_list)
-            hash_object = hashlib.md5(color_string.encode())
-            hashing = hash_object.hexdigest()
-            new_color_dict[node] = hashing
-        color_index_dict = {k: v+1 for v, k in enumerate(sorted(set(new_color_dict.values())))}
-        for node in new_color_dict:
-            new_color_dict[node] = color_index_dict[new_color_dict[node]]
-        if node_color_dict == new_color_dict or iteration_count == max_iter:
-            exit_flag = True
-        else:
-            node_color_dict = new_color_dict
-        iteration_count += 1
-        
-    g.ndata['wl_pos_enc'] = torch.LongTensor(list(node_color_dict.values()))
+    g.ndata['wl_pos_enc'] = wl_positional_encodings([g])[0]
     return g
-
@@ -9,6 +9,7 @@ import dgl
     
 """
 from layers.graph_transformer_edge_layer import GraphTransformerLayer
+from layers.dense_graph_transformer_layer import DenseBatch, DenseGraphTransformerLayer
 from layers.mlp_readout_layer import MLPReadout
 
 class GraphTransformerNet(nn.Module):
@@ -30,6 +31,12 @@ class GraphTransformerNet(nn.Module):
         self.device = net_params['device']
         self.lap_pos_enc = net_params['lap_pos_enc']
         self.wl_pos_enc = net_params['wl_pos_enc']
+        self.full_graph = net_params['full_graph']
+        # 'softmax' or 'linear' attention of the full graph layers
+        self.full_graph_attention = net_params.get('full_graph_attention', 'softmax')
+        # fused dgl attention kernels, for all layers or a list with one flag per layer
+        fused = net_params.get('fused_attention', False)
+        fused = fused if isinstance(fused, list) else [fused] * n_layers
         max_wl_role_index = 37 # this is maximum graph size in the dataset
         
         if self.lap_pos_enc:
@@ -48,9 +55,17 @@ class GraphTransformerNet(nn.Module):
         
         self.in_feat_dropout = nn.Dropout(in_feat_dropout)
         
-        self.layers = nn.ModuleList([ GraphTransformerLayer(hidden_dim, hidden_dim, num_heads, dropout,
-                                                    self.layer_norm, self.batch_norm, self.residual) for _ in range(n_layers-1) ]) 
-        self.layers.append(GraphTransformerLayer(hidden_dim, out_dim, num_heads, dropout, self.layer_norm, self.batch_norm, self.residual))
+        if self.full_graph:
+            # attention over all nodes of every graph, on the padded batch instead of complete dgl graphs
+            self.layers = nn.ModuleList([ DenseGraphTransformerLayer(hidden_dim, hidden_dim, num_heads, dropout, self.layer_norm,
+                                                    self.batch_norm, self.residual, attention=self.full_graph_attention) for _ in range(n_layers-1) ])
+            self.layers.append(DenseGraphTransformerLayer(hidden_dim, out_dim, num_heads, dropout, self.layer_norm, self.batch_norm,
+                                                          self.residual, attention=self.full_graph_attention))
+        else:
+            self.layers = nn.ModuleList([ GraphTransformerLayer(hidden_dim, hidden_dim, num_heads, dropout,
+                                                        self.layer_norm, self.batch_norm, self.residual, fused=fused[i]) for i in range(n_layers-1) ]) 
+            self.layers.append(GraphTransformerLayer(hidden_dim, out_dim, num_heads, dropout, self.layer_norm, self.batch_norm, self.residual,
+                                                     fused=fused[-1]))
         if sole_model:
             self.MLP_layer = MLPReadout(out_dim, 1)
         else:
@@ -68,14 +83,20 @@ class GraphTransformerNet(nn.Module):
         if self.wl_pos_enc:
             h_wl_pos_enc = self.embedding_wl_pos_enc(h_wl_pos_enc) 
             h = h + h_wl_pos_enc
-        if not self.edge_feat: # edge feature set to 1
-            e = torch.ones(e.size(0),1).to(self.device)
-        #e = e.transpose(1,2)
-        e = self.embedding_e(e.float())
-        
-        # convnets
-        for conv in self.layers:
-            h, e = conv(g, h, e)
+        if self.full_graph:
+            # the edges of g are not used, every node attends to the nodes of its graph
+            batch = DenseBatch(g.batch_num_nodes().to(h.device))
+            for conv in self.layers:
+                h = conv(batch, h)
+        else:
+            if not self.edge_feat: # edge feature set to 1
+                e = torch.ones(e.size(0),1).to(self.device)
+            #e = e.transpose(1,2)
+            e = self.embedding_e(e.float())
+            
+            # convnets
+            for conv in self.layers:
+                h, e = conv(g, h, e)
         g.ndata['h'] = h
         
         if self.readout == "sum":
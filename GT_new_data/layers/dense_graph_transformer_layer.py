@@ -0,0 +1,181 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+"""
+    Graph Transformer Layer on full graphs, as a dense batch
+
+    Every node attends to all nodes of its graph, itself included. The nodes
+    of the batched graph are scattered into a (graphs, nodes, dim) tensor padded
+    to the largest graph of the batch and the padding is masked, so neither the
+    complete graphs nor the per edge scores and values of dgl are built.
+"""
+
+"""
+    Util functions
+"""
+class DenseBatch:
+    def __init__(self, batch_num_nodes):
+        """
+            batch_num_nodes: number of nodes of every graph of the batched graph
+        """
+        sizes = batch_num_nodes.long()
+        self.num_graphs = len(sizes)
+        self.max_nodes = int(sizes.max()) if self.num_graphs else 0
+        # graph of every node and its position in the graph
+        self.graph = torch.repeat_interleave(torch.arange(self.num_graphs, device=sizes.device), sizes)
+        start = torch.repeat_interleave(torch.cumsum(sizes, 0) - sizes, sizes)
+        self.position = torch.arange(len(self.graph), device=sizes.device) - start
+        # (graphs, nodes), False on the padding
+        self.mask = torch.arange(self.max_nodes, device=sizes.device).unsqueeze(0) < sizes.unsqueeze(1)
+
+    def pad(self, h):
+        out = h.new_zeros((self.num_graphs, self.max_nodes) + tuple(h.shape[1:]))
+        out[self.graph, self.position] = h
+        return out
+
+    def unpad(self, h):
+        return h[self.graph, self.position]
+
+
+def softmax_attention(Q, K, V, mask):
+    """
+        Q, K, V: (graphs, heads, nodes, dim)
+        mask: (graphs, nodes), False on the padded keys
+    """
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(Q, K, V, attn_mask=mask[:, None, None, :])
+    # torch < 2.0
+    score = torch.matmul(Q, K.transpose(-1, -2)) / Q.shape[-1] ** 0.5
+    score = score.masked_fill(~mask[:, None, None, :], float('-inf'))
+    return torch.matmul(torch.softmax(score, -1), V)
+
+
+def linear_attention(Q, K, V, mask, eps=1e-6):
+    """
+        Kernelized attention with the elu + 1 feature map, linear in the number of nodes
+        "Transformers are RNNs: Fast Autoregressive Transformers with Linear Attention"
+        Katharopoulos, Angelos and Vyas, Apoorv and Pappas, Nikolaos and Fleuret, Francois, 2020
+    """
+    Q = F.elu(Q) + 1
+    K = (F.elu(K) + 1) * mask[:, None, :, None]
+    KV = torch.einsum('bhnd,bhne->bhde', K, V)
+    z = 1 / (torch.einsum('bhnd,bhd->bhn', Q, K.sum(2)) + eps)
+    return torch.einsum('bhnd,bhde,bhn->bhne', Q, KV, z)
+
+
+"""
+    Single Attention Head
+"""
+
+class DenseMultiHeadAttentionLayer(nn.Module):
+    def __init__(self, in_dim, out_dim, num_heads, use_bias, attention='softmax'):
+        super().__init__()
+
+        self.out_dim = out_dim
+        self.num_heads = num_heads
+        if attention not in ('softmax', 'linear'):
+            raise ValueError("attention has to be 'softmax' or 'linear', not {}".format(attention))
+        self.attention = attention
+
+        self.Q = nn.Linear(in_dim, out_dim * num_heads, bias=use_bias)
+        self.K = nn.Linear(in_dim, out_dim * num_heads, bias=use_bias)
+        self.V = nn.Linear(in_dim, out_dim * num_heads, bias=use_bias)
+
+    def forward(self, batch, h):
+        # Reshaping into [graphs, num_heads, nodes, feat_dim] to
+        # get projections for multi-head attention
+        shape = (batch.num_graphs, batch.max_nodes, self.num_heads, self.out_dim)
+        Q_h = batch.pad(self.Q(h)).view(shape).transpose(1, 2)
+        K_h = batch.pad(self.K(h)).view(shape).transpose(1, 2)
+        V_h = batch.pad(self.V(h)).view(shape).transpose(1, 2)
+
+        if self.attention == 'linear':
+            head_out = linear_attention(Q_h, K_h, V_h, batch.mask)
+        else:
+            head_out = softmax_attention(Q_h, K_h, V_h, batch.mask)
+
+        # back to [num_nodes, num_heads, feat_dim]
+        return batch.unpad(head_out.transpose(1, 2))
+
+
+class DenseGraphTransformerLayer(nn.Module):
+    """
+        Param:
+    """
+    def __init__(self, in_dim, out_dim, num_heads, dropout=0.0, layer_norm=False, batch_norm=True, residual=True, use_bias=False,
+                 attention='softmax'):
+        super().__init__()
+
+        self.in_channels = in_dim
+        self.out_channels = out_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.residual = residual
+        self.layer_norm = layer_norm
+        self.batch_norm = batch_norm
+
+        self.attention = DenseMultiHeadAttentionLayer(in_dim, out_dim//num_heads, num_heads, use_bias, attention)
+
+        self.O = nn.Linear(out_dim, out_dim)
+
+        if self.layer_norm:
+            self.layer_norm1 = nn.LayerNorm(out_dim)
+
+        if self.batch_norm:
+            self.batch_norm1 = nn.BatchNorm1d(out_dim)
+
+        # FFN
+        self.FFN_layer1 = nn.Linear(out_dim, out_dim*2)
+        self.FFN_layer2 = nn.Linear(out_dim*2, out_dim)
+
+        if self.layer_norm:
+            self.layer_norm2 = nn.LayerNorm(out_dim)
+
+        if self.batch_norm:
+            self.batch_norm2 = nn.BatchNorm1d(out_dim)
+
+    def forward(self, batch, h):
+        h_in1 = h # for first residual connection
+
+        # multi-head attention out
+        attn_out = self.attention(batch, h)
+        h = attn_out.reshape(-1, self.out_channels)
+
+        h = F.dropout(h, self.dropout, training=self.training)
+
+        h = self.O(h)
+
+        if self.residual:
+            h = h_in1 + h # residual connection
+
+        if self.layer_norm:
+            h = self.layer_norm1(h)
+
+        if self.batch_norm:
+            h = self.batch_norm1(h)
+
+        h_in2 = h # for second residual connection
+
+        # FFN
+        h = self.FFN_layer1(h)
+        h = F.relu(h)
+        h = F.dropout(h, self.dropout, training=self.training)
+        h = self.FFN_layer2(h)
+
+        if self.residual:
+            h = h_in2 + h # residual connection
+
+        if self.layer_norm:
+            h = self.layer_norm2(h)
+
+        if self.batch_norm:
+            h = self.batch_norm2(h)
+
+        return h
+
+    def __repr__(self):
+        return '{}(in_channels={}, out_channels={}, heads={}, residual={}, attention={})'.format(self.__class__.__name__,
+                                             self.in_channels,
+                                             self.out_channels, self.num_heads, self.residual,
+                                             self.attention.attention)
@@ -1,6 +1,7 @@
 
 import os 
 import torch
+from run_log import RunLog
 
 
 class Logger():
@@ -11,6 +12,8 @@ class Logger():
         for output_path in [self.result_file_path, self.model_file_path, self.other_file_path]:
             if not os.path.isdir(output_path):
                 os.makedirs(output_path)
+        # metrics of every epoch, buffered in memory instead of reopening a file per value
+        self.run = RunLog(self.result_file_path + 'run.jsonl')
 
     def save_parameters(self, MODEL_NAME, params, net_params):
         with open(self.result_file_path+'parameters' + '.txt', 'w') as f:
@@ -22,14 +25,10 @@ class Logger():
         #torch.save(optimizer.state_dict(), self.model_file_path+'optimizer_'+str(epoch)+'.pkl')
 
     def log_testing(self, epoch, mse, mae, rmse, cost_time):
-        with open(self.result_file_path+'loss_error.txt', 'a+') as f:
-            f.write("Test MSE: {} MAE:{} RMSE: {} cost_time:{}\n".format(mse,mae,rmse,cost_time))
-        with open(self.other_file_path + 'valid_RMSE.txt', 'a+') as f:
-            f.write("{}\n".format(rmse))
+        self.run.log('test', epoch, mse=mse, mae=mae, rmse=rmse, cost_time=cost_time)
     
     def log_training(self, epoch, avg_training_loss):
-        with open(self.result_file_path+'loss_error.txt', 'a+') as f:
-            f.write("Epoch:{}  Training loss:{}\n".format(epoch, avg_training_loss))
-        with open(self.other_file_path+'train_loss.txt', 'a+') as f:
-            f.write("{}\n".format(avg_training_loss))
-    
+        self.run.log('train', epoch, loss=avg_training_loss)
+
+    def close(self):
+        self.run.close()
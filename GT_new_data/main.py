@@ -92,11 +92,8 @@ def train_val_pipeline(MODEL_NAME, trainset, testset, params, net_params, result
         print('Time WL PE:',time.time()-st)
     
     if net_params['full_graph']:
-        st = time.time()
-        print("[!] Converting the given graphs to full graphs..")
-        trainset._make_full_graph()
-        testset._make_full_graph()
-        print('Time taken to convert to full graphs:',time.time()-st)    
+        # GraphTransformerNet attends over the padded batch, no complete graphs are built
+        print("[!] Full graph attention: {}".format(net_params.get('full_graph_attention', 'softmax')))
 
     logger.save_parameters(MODEL_NAME, params, net_params) 
     device = net_params['device']
@@ -129,8 +126,10 @@ def train_val_pipeline(MODEL_NAME, trainset, testset, params, net_params, result
             for epoch in t:
                 t.set_description('Epoch %d' % epoch)
                 start = time.time()
-                epoch_train_loss, epoch_train_mae, epoch_train_mse, optimizer = train_epoch(model, optimizer, device, train_loader, epoch)
-                epoch_test_loss, epoch_test_mae, epoch_test_mse = evaluate_network(model, device, test_loader, epoch)
+                with logger.run.timer('train'):
+                    epoch_train_loss, epoch_train_mae, epoch_train_mse, optimizer = train_epoch(model, optimizer, device, train_loader, epoch)
+                with logger.run.timer('test'):
+                    epoch_test_loss, epoch_test_mae, epoch_test_mse = evaluate_network(model, device, test_loader, epoch)
                 
                 t.set_postfix(time=time.time()-start, lr=optimizer.param_groups[0]['lr'],
                               train_loss=epoch_train_loss,
@@ -171,6 +170,7 @@ def train_val_pipeline(MODEL_NAME, trainset, testset, params, net_params, result
     print("Convergence Time (Epochs): {:.4f}".format(epoch))
     print("TOTAL TIME TAKEN: {:.4f}s".format(time.time()-t0))
     print("AVG TIME PER EPOCH: {:.4f}s".format(np.mean(per_epoch_time)))
+    logger.close()
     
 
 
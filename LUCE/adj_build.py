@@ -0,0 +1,256 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from scipy import sparse
+from scipy.spatial import cKDTree
+from adj_store import save_adjacency
+from adjacency import meta_incidence, prefix_incidence, dice_rows, haversine_distance, normalize_rows
+
+
+"""
+Row block scheduler for building adjacency matrices.
+
+The N rows are split into shards of shard_size rows. A kernel computes the
+(rows, N) csr block of every meta path for one shard,
+
+    kernel(inputs, start, stop, **params) -> [csr block of meta path 0, ...]
+
+where inputs is a dict of numpy arrays shared by all shards and params are small
+json serializable arguments. With processes > 1 the shards run in a
+concurrent.futures process pool and the inputs are copied once into shared memory
+instead of being pickled for every shard. Every finished shard is saved in
+<path>.blocks/ and skipped when an interrupted build is started again with the
+same kernel, inputs and params. The blocks are assembled into the sparse container
+at path and removed.
+
+A kernel has to be a module level function so that the pool can pickle it. The
+kernels of the preprocess scripts are below: dice_kernel for the meta path Dice
+similarity of adjacency.create_adj, optionally as a thresholded or top-k
+similarity join, and geo_kernel for the gaussian similarity of
+adjacency.gaussian_geo_adj.
+"""
+
+# arrays of the build the worker is running, attached once per process
+_INPUTS = {}
+_SHARED = []
+# objects derived from the inputs, e.g. a KD-tree, kept between the shards of a build
+_CACHE = {}
+
+
+def _attach(specs):
+    _INPUTS.clear()
+    _CACHE.clear()
+    for name, (shm_name, shape, dtype) in specs.items():
+        # the parent owns the segment and unlinks it when the build is done
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _SHARED.append(shm)
+        _INPUTS[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _run_shard(kernel, start, stop, params, block_path):
+    blocks = kernel(_INPUTS, start, stop, **params)
+    _save_block(block_path, blocks)
+    return start
+
+
+def _save_block(block_path, blocks):
+    parts = {}
+    for k, b in enumerate(blocks):
+        b = sparse.csr_matrix(b)
+        parts.update({'{}_indptr'.format(k): b.indptr.astype(np.int64), '{}_indices'.format(k): b.indices.astype(np.int32),
+                      '{}_data'.format(k): b.data, '{}_shape'.format(k): np.array(b.shape)})
+    # written to a temporary file first, a block on disk is always complete
+    tmp = block_path + '.tmp{}.npz'.format(os.getpid())
+    np.savez(tmp, meta_size=len(blocks), **parts)
+    os.replace(tmp, block_path)
+
+
+def _load_block(block_path):
+    with np.load(block_path) as f:
+        return [sparse.csr_matrix((f['{}_data'.format(k)], f['{}_indices'.format(k)], f['{}_indptr'.format(k)]),
+                                  shape=tuple(f['{}_shape'.format(k)])) for k in range(int(f['meta_size']))]
+
+
+def build_key(kernel, inputs, num_nodes, params, shard_size):
+    '''
+    sha1 of everything a block depends on, blocks of another build are not reused
+    '''
+    h = hashlib.sha1()
+    h.update(json.dumps({'kernel': kernel.__module__ + '.' + kernel.__name__, 'num_nodes': num_nodes,
+                         'params': params, 'shard_size': shard_size}, sort_keys=True).encode())
+    for name in sorted(inputs):
+        a = np.ascontiguousarray(inputs[name])
+        h.update(json.dumps([name, a.dtype.str, a.shape]).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def build_adjacency(path, kernel, inputs, num_nodes, params=None, names=None, node_ids=None,
+                    dtype=np.float64, attributes=None, join=None, shard_size=1024, processes=1):
+    '''
+    path: directory of the container, the blocks are kept in path + '.blocks'
+    kernel: kernel(inputs, start, stop, **params) -> list of (stop - start, num_nodes)
+        csr blocks, one per meta path
+    inputs: dict of numpy arrays read by the kernel
+    params: dict of the other arguments of the kernel
+    join: similarity join parameters stored in the container, see SparseAdjacency
+    processes: number of processes computing the shards
+    return: the saved SparseAdjacency
+    '''
+    params = dict(params or {})
+    inputs = {name: np.ascontiguousarray(a) for name, a in inputs.items()}
+    blocks_path = path.rstrip('/') + '.blocks'
+    key = build_key(kernel, inputs, num_nodes, params, shard_size)
+    key_path = os.path.join(blocks_path, 'key')
+    stale = True
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            stale = f.read() != key
+    if os.path.isdir(blocks_path) and stale:
+        # blocks of a build with other inputs
+        shutil.rmtree(blocks_path)
+    if not os.path.isdir(blocks_path):
+        os.makedirs(blocks_path)
+        with open(key_path, 'w') as f:
+            f.write(key)
+
+    shards = [(start, min(start + shard_size, num_nodes)) for start in range(0, num_nodes, shard_size)]
+    block_paths = [os.path.join(blocks_path, '{:012d}.npz'.format(start)) for start, _ in shards]
+    todo = [(start, stop, p) for (start, stop), p in zip(shards, block_paths) if not os.path.exists(p)]
+    if len(todo) < len(shards):
+        print('Resuming the adjacency build, {} of {} shards are done.'.format(len(shards) - len(todo), len(shards)))
+    if todo and processes > 1:
+        shms = []
+        try:
+            specs = {}
+            for name, a in inputs.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+                shms.append(shm)
+                np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+                specs[name] = (shm.name, a.shape, a.dtype.str)
+            with ProcessPoolExecutor(max_workers=processes, initializer=_attach, initargs=(specs,)) as pool:
+                futures = [pool.submit(_run_shard, kernel, start, stop, params, p) for start, stop, p in todo]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+    elif todo:
+        _INPUTS.clear()
+        _INPUTS.update(inputs)
+        _CACHE.clear()
+        try:
+            for start, stop, p in todo:
+                _run_shard(kernel, start, stop, params, p)
+        finally:
+            _INPUTS.clear()
+            _CACHE.clear()
+
+    blocks = [_load_block(p) for p in block_paths]
+    meta_size = len(blocks[0]) if blocks else len(names or [])
+    matrices = [sparse.vstack([b[k] for b in blocks], format='csr') if blocks else
+                sparse.csr_matrix((0, 0), dtype=dtype) for k in range(meta_size)]
+    adj = save_adjacency(path, matrices, names=names, node_ids=node_ids, dtype=dtype, attributes=attributes,
+                         join=join)
+    shutil.rmtree(blocks_path)
+    return adj
+
+
+def dice_inputs(incidences, threshold=None):
+    '''
+    incidences: incidence matrix of every meta path, see adjacency.meta_incidence
+    threshold: minimum similarity, adds the prefix incidence of the similarity join
+    return: inputs of dice_kernel
+    '''
+    inputs = {}
+    for k, incidence in enumerate(incidences):
+        incidence = sparse.csr_matrix(incidence, dtype=np.int32)
+        incidence.sum_duplicates()
+        matrices = {'': incidence}
+        if threshold is not None and threshold > 0:
+            matrices['p_'] = prefix_incidence(incidence, threshold)
+        for prefix, m in list(matrices.items()):
+            matrices[prefix + 't_'] = m.T.tocsr()
+        for prefix, m in matrices.items():
+            inputs.update({'{}_{}indptr'.format(k, prefix): m.indptr.astype(np.int64),
+                           '{}_{}indices'.format(k, prefix): m.indices.astype(np.int32)})
+    return inputs
+
+
+def _incidence(inputs, name, shape):
+    indptr, indices = inputs[name + 'indptr'], inputs[name + 'indices']
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=shape)
+
+
+def dice_kernel(inputs, start, stop, meta_size=1, dtype='float64', threshold=None, top_k=None):
+    '''
+    rows start:stop of the Dice similarity matrix of every meta path, the blocks
+    of adjacency.dice_adj
+    '''
+    blocks = []
+    for k in range(meta_size):
+        n, n_values = len(inputs['{}_indptr'.format(k)]) - 1, len(inputs['{}_t_indptr'.format(k)]) - 1
+        incidence = _incidence(inputs, '{}_'.format(k), (n, n_values))
+        incidence_t = _incidence(inputs, '{}_t_'.format(k), (n_values, n))
+        prefix, prefix_t = None, None
+        if '{}_p_indptr'.format(k) in inputs:
+            prefix = _incidence(inputs, '{}_p_'.format(k), (n, n_values))
+            prefix_t = _incidence(inputs, '{}_p_t_'.format(k), (n_values, n))
+        blocks.append(dice_rows(incidence, incidence_t, start, stop, prefix, prefix_t, threshold, top_k, dtype))
+    return blocks
+
+
+def build_dice(path, dfs, id_list, hid='house', names=None, node_ids=None, attributes=None,
+               threshold=None, top_k=None, shard_size=1024, processes=1):
+    '''
+    Dice adjacency of every meta path, the sparse result of adjacency.create_adj
+    dfs: dataframe of every meta path with the house id column and its attribute columns
+    threshold, top_k: similarity join, see adjacency.dice_rows
+    '''
+    incidences = [meta_incidence(df, id_list, hid) for df in dfs]
+    params = {'meta_size': len(dfs), 'threshold': threshold, 'top_k': top_k}
+    return build_adjacency(path, dice_kernel, dice_inputs(incidences, threshold), len(id_list), params=params,
+                           names=names, node_ids=node_ids, attributes=attributes,
+                           join={'threshold': threshold, 'top_k': top_k}, shard_size=shard_size, processes=processes)
+
+
+def geo_kernel(inputs, start, stop, sigma, cutoff, radius=6371):
+    '''
+    rows start:stop of the row normalized gaussian similarity of adjacency.gaussian_geo_adj
+    '''
+    lat, lon = inputs['lat'], inputs['lon']
+    n = len(lat)
+    if 'tree' not in _CACHE:
+        phi, lam = np.radians(lat), np.radians(lon)
+        # a KD-tree on points of the unit sphere, the chord length grows with the arc length
+        xyz = np.stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)), axis=1)
+        _CACHE['xyz'], _CACHE['tree'] = xyz, cKDTree(xyz)
+    chord = 2 * np.sin(min(cutoff / (2 * radius), np.pi / 2))
+    found = _CACHE['tree'].query_ball_point(_CACHE['xyz'][start:stop], chord * (1 + 1e-9))
+    i = np.repeat(np.arange(start, stop), [len(f) for f in found])
+    j = np.concatenate([np.asarray(f, dtype=np.int64) for f in found]) if len(found) else np.zeros(0, dtype=np.int64)
+    dist = haversine_distance(lat[i], lon[i], lat[j], lon[j], radius)
+    keep = (dist <= cutoff) & (i != j)
+    similarity = np.exp(- (dist[keep] ** 2) / (2 * sigma ** 2))
+    diag = np.arange(start, stop)
+    rows = np.concatenate((i[keep], diag)) - start
+    cols = np.concatenate((j[keep], diag))
+    data = np.concatenate((similarity, np.ones(stop - start)))
+    # a row sums to one on its own, so the blocks are normalized separately
+    return [normalize_rows(sparse.csr_matrix((data, (rows, cols)), shape=(stop - start, n)))]
+
+
+def build_geo(path, lat, lon, sigma, cutoff=None, names=None, node_ids=None, shard_size=1024, processes=1):
+    '''
+    gaussian similarity of the coordinates, the sparse result of adjacency.gaussian_geo_adj
+    '''
+    if cutoff is None:
+        cutoff = 4 * sigma
+    inputs = {'lat': np.asarray(lat, dtype=np.float64), 'lon': np.asarray(lon, dtype=np.float64)}
+    return build_adjacency(path, geo_kernel, inputs, len(inputs['lat']), params={'sigma': sigma, 'cutoff': cutoff},
+                           names=names, node_ids=node_ids, shard_size=shard_size, processes=processes)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+"""
+Content addressed cache of the prepared training data.
+
+An entry is keyed by the sha1 of the bytes of every input file (the processed
+csv and the adjacency files) and of the preprocessing parameters, so editing a
+csv or rebuilding an adjacency never returns stale arrays. An entry is a
+directory of .npy files plus meta.json, written to a temporary directory and
+renamed so that a killed run does not leave a half written entry. Entries
+older than max_age days are removed, then the least recently used ones until
+the cache is below max_bytes.
+"""
+
+
+def file_digest(path, chunk_size=1 << 20):
+    '''
+    path: file, or directory whose files are hashed in name order
+    '''
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            h.update(name.encode())
+            h.update(file_digest(os.path.join(path, name)).encode())
+        return h.hexdigest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class DataCache:
+    def __init__(self, root, max_bytes=None, max_age=None):
+        '''
+        root: directory of the cache
+        max_bytes: total size of the entries kept
+        max_age: days an entry is kept after its last use
+        '''
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, files, params):
+        '''
+        files: input files of the entry
+        params: json serializable parameters of the preprocessing
+        '''
+        h = hashlib.sha1()
+        h.update(json.dumps(params, sort_keys=True).encode())
+        for path in files:
+            h.update(file_digest(path).encode())
+        return h.hexdigest()
+
+    def load(self, key):
+        '''
+        return: dict of the arrays of the entry, None on a miss
+        '''
+        path = os.path.join(self.root, key)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), allow_pickle=True) for name in meta['arrays']}
+        # the modification time of meta.json is the last use of the entry
+        os.utime(os.path.join(path, 'meta.json'))
+        return arrays
+
+    def save(self, key, arrays, params=None):
+        '''
+        arrays: dict of numpy arrays
+        '''
+        path = os.path.join(self.root, key)
+        tmp = path + '.tmp{}'.format(os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), a)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'arrays': list(arrays), 'params': params, 'created': time.time()}, f, indent=4)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''
+        remove the entries older than max_age, then the least recently used
+        ones until the cache is smaller than max_bytes
+        keep: key that is never removed
+        '''
+        entries = []
+        for key in os.listdir(self.root):
+            meta = os.path.join(self.root, key, 'meta.json')
+            if key != keep and os.path.exists(meta):
+                entries.append((os.path.getmtime(meta), key))
+        entries.sort()
+        now = time.time()
+        if self.max_age is not None:
+            for used, key in list(entries):
+                if now - used > self.max_age * 24 * 3600:
+                    shutil.rmtree(os.path.join(self.root, key))
+                    entries.remove((used, key))
+        if self.max_bytes is not None:
+            sizes = {key: _size(os.path.join(self.root, key)) for _, key in entries}
+            total = sum(sizes.values()) + (_size(os.path.join(self.root, keep)) if keep is not None else 0)
+            for _, key in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(os.path.join(self.root, key))
+                total -= sizes[key]
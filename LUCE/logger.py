@@ -1,6 +1,7 @@
 
 import os 
 import torch
+from run_log import RunLog
 
 
 class Logger():
@@ -13,6 +14,8 @@ class Logger():
                 os.makedirs(output_path)
         if not os.path.isdir(self.result_file_path+'predictions/'):
             os.makedirs(self.result_file_path+'predictions/')
+        # metrics of every epoch, buffered in memory instead of reopening a file per value
+        self.run = RunLog(self.result_file_path + 'run.jsonl')
 
     def save_parameters(self, config):
         with open(self.result_file_path+'parameters.txt', 'w') as f:
@@ -32,22 +35,16 @@ class Logger():
         torch.save(optimizer.state_dict(), self.model_file_path+'optimizer_'+str(epoch)+'.pkl')
 
     def log_testing(self, epoch, mse, mae, rmse, mape, cost_time):
-        if epoch % 10 == 0:
-            with open(self.result_file_path+'loss_error.txt', 'a+') as f:
-                f.write("Test MSE: {} MAE: {} RMSE: {} cost_time: {}\n".format(mse,mae,rmse, mape, cost_time))
-            with open(self.other_file_path + 'valid_RMSE.txt', 'a+') as f:
-                f.write("{}\n".format(rmse))
-            with open(self.other_file_path + 'valid_MAPE.txt', 'a+') as f:
-                f.write("{}\n".format(mape))
-            with open(self.other_file_path + 'valid_MAE.txt', 'a+') as f:
-                f.write("{}\n".format(mae))
+        self.run.log('test', epoch, mse=mse, mae=mae, rmse=rmse, mape=mape, cost_time=cost_time)
         print("Test MSE: {} MAE: {} RMSE: {} MAPE: {} cost_time: {}".format(mse, mae, rmse, mape, cost_time))
     
+    def log_validation(self, epoch, mse, mae, rmse, mape):
+        self.run.log('valid', epoch, mse=mse, mae=mae, rmse=rmse, mape=mape)
+        print("Validation MSE: {} MAE: {} RMSE: {} MAPE: {}".format(mse, mae, rmse, mape))
+
     def log_training(self, epoch, avg_training_loss):
-        if epoch % 10 == 0:
-            with open(self.result_file_path+'loss_error.txt', 'a+') as f:
-                f.write("Epoch:{}  Training loss:{}\n".format(epoch, avg_training_loss))
-            with open(self.other_file_path+'train_loss.txt', 'a+') as f:
-                f.write("{}\n".format(avg_training_loss))
+        self.run.log('train', epoch, loss=avg_training_loss)
         print("Epoch:{}  Training loss:{}".format(epoch, avg_training_loss))
-    
+
+    def close(self):
+        self.run.close()
@@ -12,6 +12,138 @@ The output is graph embedding of all data: Nodes * output_dim
 """
 
 
+class TiledAdjacency:
+    """
+    Adjacency of the houses in every month, ones(T, T) kron A, which is what
+    np.tile(A, (T, T)) stored densely: a house is connected to the meta path
+    neighbours of its house in all T months. Only A (meta_size * houses * houses
+    or houses * houses) is kept, and the product with X (T*houses * d) is
+    A @ (sum of the T month blocks of X), repeated T times.
+
+    sub(rows, cols) is the operator from the houses cols to the houses rows in
+    every month, for a forward over the receptive field of a batch only.
+    """
+
+    def __init__(self, base, tiles, loops=None):
+        self.base = torch.as_tensor(base)
+        self.tiles = tiles
+        # position of every row among the columns of a sub operator, for the self loops
+        self.loops = loops
+
+    @property
+    def shape(self):
+        return torch.Size(self.base.shape[:-2] + (self.tiles * self.base.shape[-2], self.tiles * self.base.shape[-1]))
+
+    def __len__(self):
+        return self.base.shape[0]
+
+    def __getitem__(self, i):
+        return TiledAdjacency(self.base[i], self.tiles, self.loops)
+
+    def to(self, *args, **kwargs):
+        base = self.base.to(*args, **kwargs)
+        loops = self.loops.to(base.device) if self.loops is not None else None
+        return TiledAdjacency(base, self.tiles, loops)
+
+    def float(self):
+        return self.to(torch.float)
+
+    def matmul(self, x, self_loops=False):
+        # x: (T*houses) * d, or meta_size * (T*houses) * d with one input per meta path of the base
+        # self_loops: multiply with ones(T, T) kron A + I
+        houses = self.base.shape[-1]
+        blocks = x.view(x.shape[:-2] + (self.tiles, houses, x.shape[-1]))
+        out = torch.matmul(self.base, blocks.sum(-3))
+        out = out.repeat((1,) * (out.dim() - 2) + (self.tiles, 1))
+        if not self_loops:
+            return out
+        if self.loops is None:
+            return out + x
+        return out + blocks[..., self.loops, :].reshape(x.shape[:-2] + (-1, x.shape[-1]))
+
+    def neighbours(self, houses):
+        """
+        houses: sorted house ids
+        return: sorted ids of the houses and their neighbours in any meta path
+        """
+        base = self.base if self.base.dim() == 3 else self.base.unsqueeze(0)
+        linked = (base.index_select(1, houses) != 0).any(0).any(0)
+        linked[houses] = True
+        return linked.nonzero().view(-1)
+
+    def sub(self, rows, cols):
+        """
+        rows, cols: sorted house ids, the rows have to be among the cols
+        return: the operator from the houses cols to the houses rows
+        """
+        base = self.base.index_select(-2, rows).index_select(-1, cols)
+        return TiledAdjacency(base, self.tiles, torch.searchsorted(cols, rows))
+
+    __matmul__ = matmul
+
+    def to_dense(self):
+        return self.base.repeat((1,) * (self.base.dim() - 2) + (self.tiles, self.tiles))
+
+
+class StackedAdjacency:
+    """
+    A_k + I of all meta paths as one meta_size * Nodes * Nodes sparse tensor, built
+    once instead of adding torch.eye(Nodes) to every adjacency in every call.
+    matmul multiplies all meta paths in one spmm, a Nodes * d input is shared by
+    the meta paths and a meta_size * Nodes * d input has one block per meta path.
+    normalize: D^-1/2 (A_k + I) D^-1/2 instead of A_k + I
+    """
+
+    def __init__(self, adj, normalize=False):
+        if isinstance(adj, (list, tuple)):
+            adj = torch.stack([torch.as_tensor(a) for a in adj])
+        adj = torch.as_tensor(adj)
+        adj = adj.coalesce() if adj.is_sparse else adj.to_sparse()
+        meta_size, n = adj.shape[0], adj.shape[-1]
+        loops = torch.arange(n, device=adj.device).repeat(meta_size)
+        index = torch.cat((adj.indices(), torch.stack((torch.arange(meta_size, device=adj.device).repeat_interleave(n),
+                                                       loops, loops))), 1)
+        values = torch.cat((adj.values(), torch.ones(meta_size * n, dtype=adj.dtype, device=adj.device)))
+        adj = torch.sparse_coo_tensor(index, values, adj.shape).coalesce()
+        if normalize:
+            index, values = adj.indices(), adj.values()
+            degree = torch.zeros(meta_size, n, dtype=values.dtype, device=values.device)
+            degree.index_put_((index[0], index[1]), values, accumulate=True)
+            d = degree.pow(-0.5)
+            values = d[index[0], index[1]] * values * d[index[0], index[2]]
+            adj = torch.sparse_coo_tensor(index, values, adj.shape).coalesce()
+        self.adj = adj
+        # the meta paths stacked on the rows, (meta_size * Nodes) * Nodes, for an input shared by them
+        index = adj.indices()
+        self.rows = torch.sparse_coo_tensor(torch.stack((index[0] * n + index[1], index[2])), adj.values(),
+                                            (meta_size * n, n)).coalesce()
+
+    @property
+    def shape(self):
+        return self.adj.shape
+
+    def __len__(self):
+        return self.adj.shape[0]
+
+    def to(self, *args, **kwargs):
+        stacked = StackedAdjacency.__new__(StackedAdjacency)
+        stacked.adj, stacked.rows = self.adj.to(*args, **kwargs), self.rows.to(*args, **kwargs)
+        return stacked
+
+    def float(self):
+        return self.to(torch.float)
+
+    def matmul(self, x, self_loops=True):
+        if not self_loops:
+            raise ValueError('the self loops are part of a StackedAdjacency')
+        meta_size, n = self.adj.shape[0], self.adj.shape[-1]
+        if x.dim() == 2:
+            return torch.sparse.mm(self.rows, x).view(meta_size, n, -1)
+        return torch.bmm(self.adj, x)
+
+    __matmul__ = matmul
+
+
 class GraphConvolution(nn.Module):
     def __init__(self, in_features, out_features, bias=True):
         super(GraphConvolution, self).__init__()
@@ -31,7 +163,16 @@ class GraphConvolution(nn.Module):
             self.bias.data.uniform_(-stdv, stdv)
 
     def forward(self, input, adj):
-        support = torch.mm(input.float(), self.weight.float())
+        # input: Nodes * in_features, or meta_size * Nodes * in_features with one input per meta path
+        support = torch.matmul(input.float(), self.weight.float())
+        if isinstance(adj, (TiledAdjacency, StackedAdjacency)):
+            # (A+I) @ support without building the tiled matrix or adding an identity,
+            # for all meta paths at once if adj is stacked
+            output = adj.float().matmul(support, self_loops=True)
+            if self.bias is not None:
+                return output + self.bias
+            else:
+                return output
         adj = adj + torch.eye(adj.shape[0],adj.shape[0]).to(input.device).float()  # A+I
         #print(adj.type(), support.type())
         #print(adj.shape, support.shape)
@@ -61,26 +202,49 @@ class GCN2lv(nn.Module):
         self.gc2 = GraphConvolution(gc1_outdim, gc2_outdim)
         self.dropout = dropout
 
-    def forward(self, adj, x):
-        # Each meta-graph is passed to GCN separately
-        gcn_out = []
-        shape = x.shape[0]
-        for i in range(self.meta_size):
-            gcn_out.append(F.relu(self.gc1(x, adj[i])))
-            gcn_out[i] = F.relu(self.gc2(gcn_out[i], adj[i]))
-            gcn_out[i] = gcn_out[i].view(1,shape*self.gc2_outdim)
-
-        x = gcn_out[0]
-        for i in range(1, self.meta_size):
-            x = torch.cat((x, gcn_out[i]), 0)
-        x = torch.t(x)
-        # print(self.W)
-        x = F.relu(torch.mm(x, self.W))
-        x = x.view(shape, self.gc2_outdim)
+    def forward(self, adj, x, adj2=None):
+        # adj2: adjacency of the second layer if it is not adj, e.g. a TiledAdjacency.sub
+        # all meta-graphs are passed to the GCN together
+        x = meta_path_gcn(self, adj, x, adj2)
         x = F.dropout(x,  self.dropout, training=self.training)
         return x
 
 
+def stack_meta_paths(adj, meta_size, cache=None):
+    """
+    adj: TiledAdjacency or StackedAdjacency, or a meta_size * Nodes * Nodes tensor
+    cache: module whose last StackedAdjacency is reused while adj is the same object
+    return: the first meta_size meta paths of adj as one stacked adjacency
+    """
+    if isinstance(adj, (TiledAdjacency, StackedAdjacency)):
+        return adj[:meta_size] if len(adj) != meta_size and isinstance(adj, TiledAdjacency) else adj
+    cached = getattr(cache, '_stacked', None)
+    if cached is not None and cached[0] is adj:
+        return cached[1]
+    stacked = StackedAdjacency(adj[:meta_size])
+    if cache is not None:
+        cache._stacked = (adj, stacked)
+    return stacked
+
+
+def meta_path_gcn(module, adj, x, adj2=None):
+    """
+    The two layer GCN of the LUCE models on every meta path, combined with the
+    weights of the meta paths: relu(sum_k W_k * relu(gc2(relu(gc1(x, A_k)), A_k))).
+    The meta paths run together on a stacked adjacency, so the first layer
+    multiplies x with its weight once, every layer is one batched product and
+    the meta paths are combined with an einsum instead of cat, t and mm.
+    module: model with gc1, gc2, W and meta_size
+    adj2: adjacency of the second layer if it is not adj, e.g. a TiledAdjacency.sub
+    return: Nodes * gc2 out_features
+    """
+    adj = stack_meta_paths(adj, module.meta_size, module)
+    adj2 = adj if adj2 is None else stack_meta_paths(adj2, module.meta_size)
+    h = F.relu(module.gc1(x, adj))
+    h = F.relu(module.gc2(h, adj2))
+    return F.relu(torch.einsum('knd,k->nd', h, module.W[:, 0].float()))
+
+
 # Public LSTM version
 class r_gcn2lv_1LSTMs(nn.Module):
     def __init__(self, gcn_input_dim, gc1_out_dim, lstm_input_dim, hidden_dim,
@@ -104,13 +268,16 @@ class r_gcn2lv_1LSTMs(nn.Module):
         self.linear_price = nn.Linear(gcn_input_dim, label_out_dim)
         self.LeakyReLU = nn.LeakyReLU(0.2)
 
-    def forward(self, adj, x, y_index):
+    def forward(self, adj, x, y_index, receptive_field=False):
         """
         :param x: Nodes * input_dim
         :param adj: meta_size * Nodes * Nodes
         :param y_index: last_month(1) * batch_size
+        :param receptive_field: only compute the houses y_index depends on, see forward_receptive_field
         :return: Global features and the price of the last month
         """
+        if receptive_field and isinstance(adj, TiledAdjacency):
+            return self.forward_receptive_field(adj, x, y_index)
         Nodes, num_features = x.size()
         month_len, batch_size = y_index.size()
         #print('y_index: ' + str(y_index.shape))
@@ -146,6 +313,32 @@ class r_gcn2lv_1LSTMs(nn.Module):
             out_price = torch.stack(label_list, 0)  # Output 2: label of the house participating in the transaction this month
         return out_allmonth, self.LeakyReLU(out_price)
 
+    def forward_receptive_field(self, adj, x, y_index):
+        """
+        forward of the houses of y_index only, the same prices as forward.
+        The price of a house in a month is the LSTM over the embeddings of the
+        house in all months, and the embedding of the second GCN layer depends
+        on the 2-hop meta path neighbours of the house in all months, so the
+        first layer runs on the 1-hop houses and the input on the 2-hop houses
+        :param adj: TiledAdjacency
+        """
+        Nodes, num_features = x.size()
+        house_size = int(Nodes / self.all_month)
+        houses = torch.unique(y_index % house_size)
+        hop1 = adj.neighbours(houses)
+        hop2 = adj.neighbours(hop1)
+        x_hop2 = x.view(self.all_month, house_size, num_features)[:, hop2].reshape(-1, num_features)
+        # only the GCN of the last month reaches the prices in forward
+        g_emb = self.glstm[self.month_len - 1](adj.sub(hop1, hop2), x_hop2, adj.sub(houses, hop1))
+        sequence = g_emb.view(self.all_month, len(houses), -1)
+        out, hidden = self.lstm(sequence)
+        out_price_t = self.linear_price(out.reshape(-1, self.hidden_dim))
+        # rows of the nodes of y_index among the computed month * house rows
+        rows = torch.div(y_index, house_size, rounding_mode='floor') * len(houses) + \
+            torch.searchsorted(houses, y_index % house_size)
+        out_price = out_price_t[rows]
+        return x, self.LeakyReLU(out_price)
+
 
 class GCN2lv_static(nn.Module):
     def __init__(self, config):
@@ -163,22 +356,8 @@ class GCN2lv_static(nn.Module):
         self.dense2 = nn.Linear(config.gc2_outdim, 1)
 
     def forward(self, x, adj):
-        # Pass each meta-graph into GCN separately
-        gcn_out = []
-        shape = x.shape[0]
-        for i in range(self.meta_size):
-            gcn_out.append(F.relu(self.gc1(x, adj[i])))
-            gcn_out[i] = F.relu(self.gc2(gcn_out[i], adj[i]))
-            #gcn_out[i] = F.relu(self.gc3(gcn_out[i], adj[i]))
-            gcn_out[i] = gcn_out[i].view(1,shape*self.gc2_outdim)
-
-        x = gcn_out[0]
-        for i in range(1, self.meta_size):
-            x = torch.cat((x, gcn_out[i]), 0)
-        x = torch.t(x)
-        x = F.relu(torch.mm(x, self.W))
-        # print(self.W,flush=True)
-        x = x.view(shape,self.gc2_outdim)
+        # Pass all meta-graphs into GCN together
+        x = meta_path_gcn(self, adj, x)
         x = F.dropout(x, self.dropout, training=self.training)
         x = self.dense2(x)
         return x
@@ -203,23 +382,11 @@ class GCNlstm_static(nn.Module):
         self.linear_price = nn.Linear(self.gc2_outdim, 1)
 
     def forward(self, x, adj):
-        # Pass each meta-graph into GCN separately
-        gcn_out = []
+        # Pass all meta-graphs into GCN together
         shape = x.shape[0]
         house_size = self.house_size
         seq_len = int(x.shape[0]/house_size)
-        for i in range(self.meta_size):
-            gcn_out.append(F.relu(self.gc1(x, adj[i])))
-            gcn_out[i] = F.relu(self.gc2(gcn_out[i], adj[i]))
-            gcn_out[i] = gcn_out[i].view(1, shape*self.gc2_outdim)
-
-        x = gcn_out[0]
-        for i in range(1, self.meta_size):
-            x = torch.cat((x, gcn_out[i]), 0)
-        x = torch.t(x)
-        x = F.relu(torch.mm(x, self.W))
-        # print(self.W,flush=True)
-        x = x.view(shape, self.gc2_outdim)
+        x = meta_path_gcn(self, adj, x)
         x = F.dropout(x, self.dropout, training=self.training)
         seq_list = []
         for i in range(seq_len):
@@ -257,23 +424,11 @@ class T_GCN(nn.Module):
         self.linear_price = nn.Linear(self.gc2_outdim, 1)
 
     def forward(self, adj, x):
-        # Pass each meta-graph into GCN separately
-        gcn_out = []
+        # Pass all meta-graphs into GCN together
         shape = x.shape[0]
         house_size = self.house_size
         seq_len = int(x.shape[0]/house_size)
-        for i in range(self.meta_size):
-            gcn_out.append(F.relu(self.gc1(x, adj[i])))
-            gcn_out[i] = F.relu(self.gc2(gcn_out[i], adj[i]))
-            gcn_out[i] = gcn_out[i].view(1, shape*self.gc2_outdim)
-
-        x = gcn_out[0]
-        for i in range(1, self.meta_size):
-            x = torch.cat((x, gcn_out[i]), 0)
-        x = torch.t(x)
-        x = F.relu(torch.mm(x, self.W))
-        # print(self.W,flush=True)
-        x = x.view(shape, self.gc2_outdim)
+        x = meta_path_gcn(self, adj, x)
         x = F.dropout(x, self.dropout, training=self.training)
 
         seq_list = []
@@ -1,10 +1,11 @@
 import os
 from time import time
 import dgl
-import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from adj_build import build_dice
+from panel import fill_gaps
 import matplotlib.pyplot as plt
 import argparse
 from sklearn.decomposition import PCA
@@ -12,44 +13,6 @@ from sklearn.preprocessing import MinMaxScaler
 from sklearn.externals import joblib 
 
 
-def construct_graph_from_df(df, G=None, hid='house'):
-    '''
-    df: dataframe containing the data
-    G: networkx graph to which the data is to be added
-    '''
-    if G is None:
-        G = nx.Graph()
-    l = list(df.columns)
-    done_house = []
-    l.remove(hid)
-    for _, row in df.iterrows():
-        if row[hid] in done_house:
-            continue
-        G.add_node(row[hid])
-        done_house.append(row[hid])
-        for col in l:
-            G.add_node(row[col])
-            G.add_edge(row[hid], row[col])
-    return G
-
-# create adjacency matrix following the equaation in paper
-# https://arxiv.org/abs/2008.05880
-def create_adj(G, id_list):
-    '''
-    G: networkx graph for the meta path
-    id_list: list of ids for which adjacency matrix is to be created
-    '''
-    adj = np.zeros((len(id_list), len(id_list)), dtype=np.float64)
-    for i, h1 in enumerate(id_list):
-        for j, h2 in enumerate(id_list):
-            l1 = [t[1] for t in list(G.edges(h1))]
-            l2 = [t[1] for t in list(G.edges(h2))]
-            den = len(l1) + len(l2)
-            num = 2 * len(list(set(l1) & set(l2)))
-            similarity = num / den
-            adj[i][j] = similarity
-    return adj
-
 def apply_PC(A):
     '''
     A: adjacency matrix
@@ -64,6 +27,11 @@ if __name__ == '__main__':
     parser.add_argument("--data_path" , type=str, default='./data/dataset_realestate.csv')
     parser.add_argument("--create_adj", type=int, default=1)
     parser.add_argument("--fill_gaps", type=int, default=1)
+    # number of processes filling the gaps, one year at a time, and building the adjacency
+    parser.add_argument("--processes", type=int, default=1)
+    # similarity join, only keep similarities of at least threshold and the top_k of every house
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--top_k", type=int, default=None)
     args = parser.parse_args()
 
     df = pd.read_csv(args.data_path, index_col=False, encoding="utf8")
@@ -93,50 +61,8 @@ if __name__ == '__main__':
     df = df.reset_index(drop=True)
     df_lstm = df.copy()
     if args.fill_gaps:
-        
-        # if house is not in the year, fill the missing value with price 0
-        for i in list(set(df.year)):
-            df_year = df[df['year'] == i]
-            # find average price of the year
-            avg_price = df_year.price.mean()
-            houses = list(set(df_year.house))
-            for h in all_houses:
-                if h not in houses:
-                    # find the average price of the house in other years
-                    #avg_price = df[df['house'] == h].price.mean()
-                    # find house from other years
-                    row = df[df['house'] == h].iloc[0].copy()
-                    row.price = avg_price
-                    row.year = i
-                    #print(row)
-                    df_year = df_year.append(row, ignore_index=True)
-            df_year = df_year.sort_values(by=['house'])
-            df_year = df_year.reset_index(drop=True)
-            if i == list(set(df.year))[0]:
-                df_new = df_year
-            else:
-                df_new = pd.concat((df_new, df_year))
-        
-        '''
-        # if house is not in the year, fill the missing value the next year's price
-        for i in list(set(df.year)):
-            df_year = df[df['year'] == i]
-            houses = (set(df_year.house))
-            for h in all_houses - houses:
-                # find house from the next years
-                row = df[df['house'] == h].sort_values('year').iloc[0].copy()
-                row.year = i
-                #print(row)
-                df_year = df_year.append(row, ignore_index=True)
-            df_year = df_year.sort_values(by=['house'])
-            df_year = df_year.reset_index(drop=True)
-            if i == list(set(df.year))[0]:
-                df_new = df_year
-            else:
-                df_new = pd.concat((df_new, df_year))
-            #print(len(df_year))
-        '''
-        df = df_new
+        # if house is not in the year, fill the missing value with the average price of the year
+        df = fill_gaps(df, ['year'], fill='mean', processes=args.processes)
     # sort houses by year and house id
     df = df.sort_values(by=['year', 'house'])
     #df_lstm = df.copy()
@@ -154,11 +80,13 @@ if __name__ == '__main__':
         df_h = df_single[house_meta]
         #print(df_h.shape)
         df_g = df_single[geo_meta]
-        Gh = construct_graph_from_df(df_h)
-        Gg = construct_graph_from_df(df_g)
         # Create adjacency matrix for each meta path
-        Ah = create_adj(Gh, df_single.house.tolist())
-        Ag = create_adj(Gg, df_single.house.tolist())
+        Ah = build_dice('./data/adjacency_house_yearly', [df_h], df_single.house.tolist(), names=['house'],
+                        node_ids=df_single.house.values, threshold=args.threshold,
+                        top_k=args.top_k, processes=args.processes)[0]
+        Ag = build_dice('./data/adjacency_geo_yearly', [df_g], df_single.house.tolist(), names=['geo'],
+                        node_ids=df_single.house.values, threshold=args.threshold,
+                        top_k=args.top_k, processes=args.processes)[0]
 
         print("The true shape of adjacency matrix for house meta path is {}".format(Ah.shape)) 
         print("The true shape of adjacency matrix for geo meta path is {}".format(Ag.shape))
@@ -167,12 +95,6 @@ if __name__ == '__main__':
         #Ah = apply_PC(Ah)
         #Ag = apply_PC(Ag)
 
-        np.save('./data/adjacency_house_yearly.npy', Ah)
-        np.save('./data/adjacency_geo_yearly.npy', Ag)
-        # It is better to save the adjacency matrix in sparse format, but it is not working
-        #sparse.save_npz('./data/adjacency_house.npz', sparse.csr_matrix(Ah))
-        #sparse.save_npz('./data/adjacency_geo.npz', sparse.csr_matrix(Ag))
-
     # prepare data for training using one-hot encoding
     df = pd.get_dummies(df)
     # move the target column to the last
@@ -53,7 +53,7 @@ if __name__ == '__main__':
     labels = torch.tensor(labels).to(device)
     train_index = torch.LongTensor(train_index).to(device)
     test_index = torch.LongTensor(test_index).to(device)
-    adj = torch.tensor(adj).to(device).float()
+    adj = adj.to(device).float()
     
     print('features: ' + str(features.shape))
     print('labels: ' + str(labels.shape))
@@ -30,11 +30,24 @@ class DefaultConfig:
         self.bidirectional = True
         self.yearly = True
         self.concat = not self.yearly
+        # cache of the prepared data, keyed by the content of the inputs
+        self.cache = True
+        self.cache_max_bytes = 20 * 2**30
+        self.cache_max_age = 30  # days
 
 
 class PrelifelongConfig(DefaultConfig):
     def __init__(self, device):
         super().__init__(device)
+        # share of the training houses held out to select the epoch and stop early, see utils.EvalScheduler
+        self.valid_ratio = 0.1
+        # evaluation schedule and early stopping on the validation mse
+        self.eval_every = 10
+        self.eval_plateau = 50
+        self.eval_patience = 100
+        self.eval_min_delta = 0.0
+        # train on the receptive field of the batch houses instead of the whole graph
+        self.receptive_field = True
         self.yearly = True # Wheither to use yearly data or monthly data
         self.result_path = 'result_prelifelong_yearly/'
         self.dataset = 'processed_data_yearly.csv'
@@ -21,54 +21,17 @@ df = df.rename(columns={'date': 'month', 'id': 'house'})
 
 import os
 from time import time
-import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from adj_build import build_dice
+from panel import fill_gaps
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import MinMaxScaler
 import joblib 
 import time
 
-def construct_graph_from_df(df, G=None, hid='house'):
-    '''
-    df: dataframe containing the data
-    G: networkx graph to which the data is to be added
-    '''
-    if G is None:
-        G = nx.Graph()
-    l = list(df.columns)
-    done_house = []
-    l.remove(hid)
-    for _, row in df.iterrows():
-        if row[hid] in done_house:
-            continue
-        G.add_node(row[hid])
-        done_house.append(row[hid])
-        for col in l:
-            G.add_node(row[col])
-            G.add_edge(row[hid], row[col])
-    return G
-
-# create adjacency matrix following the equaation in paper
-# https://arxiv.org/abs/2008.05880
-def create_adj(G, id_list):
-    '''
-    G: networkx graph for the meta path
-    id_list: list of ids for which adjacency matrix is to be created
-    '''
-    adj = np.zeros((len(id_list), len(id_list)), dtype=np.float64)
-    for i, h1 in enumerate(id_list):
-        for j, h2 in enumerate(id_list):
-            l1 = [t[1] for t in list(G.edges(h1))]
-            l2 = [t[1] for t in list(G.edges(h2))]
-            den = len(l1) + len(l2)
-            num = 2 * len(list(set(l1) & set(l2)))
-            similarity = num / den
-            adj[i][j] = similarity
-    return adj
-
 def apply_PC(A):
     '''
     A: adjacency matrix
@@ -98,28 +61,8 @@ all_houses = (set(df.house))
 df = df.sort_values(by=['month', 'house'])
 df = df.reset_index(drop=True)
 
-for i in list(set(df.month)):
-    df_year = df[df['month'] == i]
-    # find average price of the year
-    avg_price = df_year.price.mean()
-    houses = list(set(df_year.house))
-    for h in all_houses:
-        if h not in houses:
-            # find the average price of the house in other years
-            #avg_price = df[df['house'] == h].price.mean()
-            # find house from other years
-            row = df[df['house'] == h].iloc[0].copy()
-            row.price = avg_price
-            row.month = i
-            #print(row)
-            df_year = df_year.append(row, ignore_index=True)
-    df_year = df_year.sort_values(by=['house'])
-    df_year = df_year.reset_index(drop=True)
-    if i == list(set(df.month))[0]:
-        df_new = df_year
-    else:
-        df_new = pd.concat((df_new, df_year))
-df = df_new
+# if house is not in the month, fill the missing value with the average price of the month
+df = fill_gaps(df, ['month'], fill='mean')
 
 
 df = df.sort_values(by=['month', 'house'])
@@ -138,11 +81,11 @@ df_single = df[df['month']==1]
 df_h = df_single[house_meta]
 #print(df_h.shape)
 df_g = df_single[geo_meta]
-Gh = construct_graph_from_df(df_h)
-Gg = construct_graph_from_df(df_g)
 # Create adjacency matrix for each meta path
-Ah = create_adj(Gh, df_single.house.tolist())
-Ag = create_adj(Gg, df_single.house.tolist())
+Ah = build_dice('./data/adjacency_house_yearly', [df_h], df_single.house.tolist(), names=['house'],
+                node_ids=df_single.house.values, processes=1)[0]
+Ag = build_dice('./data/adjacency_geo_yearly', [df_g], df_single.house.tolist(), names=['geo'],
+                node_ids=df_single.house.values, processes=1)[0]
 
 print("The true shape of adjacency matrix for house meta path is {}".format(Ah.shape)) 
 print("The true shape of adjacency matrix for geo meta path is {}".format(Ag.shape))
@@ -151,9 +94,6 @@ print("The true shape of adjacency matrix for geo meta path is {}".format(Ag.sha
 #Ah = apply_PC(Ah)
 #Ag = apply_PC(Ag)
 
-np.save('./data/adjacency_house_yearly.npy', Ah)
-np.save('./data/adjacency_geo_yearly.npy', Ag)
-
 
 
 # prepare data for training using one-hot encoding
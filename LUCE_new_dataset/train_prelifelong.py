@@ -60,7 +60,7 @@ def main(config):
     update_len = config.update_len
     device = torch.device(config.device)
 
-    adj, features, labels, train_index, test_index = prepare_data(config)
+    adj, features, labels, train_index, valid_index, test_index = prepare_data(config, config.valid_ratio)
     whole_house_size = features.shape[0]
     feature_size = features.shape[1]
     hidden_dim = feature_size # hidden_dim is consistent with the dimension of embedding
@@ -69,15 +69,15 @@ def main(config):
     
     # data batch processing
     train_index_batch = make_index_batch(train_index, batch_size)
-    test_index_batch = make_index_batch(test_index, batch_size)
-    print("test_index_batch: " + str(test_index_batch.shape))
     # tensorization
     train_index_batch = train_index_batch.to(device)
     print("train_index_batch: " + str(train_index_batch.shape))
-    test_index_batch = test_index_batch.to(device)
-    adj = torch.tensor(adj).to(device)
+    valid_index_full = torch.LongTensor(valid_index).to(device)
+    test_index_full = torch.LongTensor(test_index).to(device)
+    adj = adj.to(device)
     features = torch.tensor(features).to(device)
     labels = torch.tensor(labels).to(device)
+    scaler = joblib.load(config.data_path + 'scaler_price.pkl')
 
     #  model training
     for cur_month in range(1, config.seq_len+1):
@@ -87,18 +87,18 @@ def main(config):
         if cur_month <= update_len:
             model_lstm_len = cur_month
             train_index_p = train_index_batch[:, 0: cur_month, :]#.unsqueeze(1)
-            test_index_p = test_index_batch[:, 0: cur_month, :]#.unsqueeze(1)
         else:
             model_lstm_len = update_len
             train_index_p = train_index_batch[:, cur_month - model_lstm_len: cur_month, :]#.unsqueeze(1)
-            test_index_p = test_index_batch[:, cur_month - model_lstm_len: cur_month, :]#.unsqueeze(1)
         #print('train_index_p: ' + str(train_index_p.shape))
-        #print('test_index_p: ' + str(test_index_p.shape))
         Y_train_batch = make_Y_from_index(labels, train_index_p).to(device)
-        Y_test_batch = make_Y_from_index(labels, test_index_p).to(device)
+        # every validation and test house once, for the evaluation in one pass
+        valid_index_m = valid_index_full[cur_month - model_lstm_len: cur_month]
+        Y_valid = labels[valid_index_m]
+        test_index_m = test_index_full[cur_month - model_lstm_len: cur_month]
+        Y_test = labels[test_index_m]
         batch_num = train_index_batch.shape[0]
         print('Y_train_batch: ' + str(Y_train_batch.shape))
-        #print('Y_test_batch: ' + str(Y_test_batch.shape))
 
         # Given parameters, so that the data dimension after GCN and lstm does not change
         model = r_gcn2lv_1LSTMs(gcn_input_dim=feature_size, gc1_out_dim=gc1_out_dim, lstm_input_dim=feature_size,
@@ -157,83 +157,56 @@ def main(config):
         loss_criterion = eval(config.loss)
         
         # set the training cycle of each month's model to be the same
+        evaluation = EvalScheduler(train_epoch, every=config.eval_every, plateau=config.eval_plateau,
+                                   patience=config.eval_patience, min_delta=config.eval_min_delta)
+        best_state = None
         for i in range(train_epoch):
             start_time = time.time()
+            training_loss = 0
+            model.train()
             for b in range(batch_num):
-                training_loss = 0
-                mae_list = 0
-                rmse_list = 0
-                mse_list = 0
-                mape_list = 0
-                model.train()
                 optimizer.zero_grad()
                 #print(train_index_p[b].shape, features.shape, adj.shape)
-                new_embedding, out_price = model(adj, features, train_index_p[b])
-                new_embedding = Variable(new_embedding.data, requires_grad=True)
+                new_embedding, out_price = model(adj, features, train_index_p[b], receptive_field=config.receptive_field)
                 #print("out_price", out_price)
                 loss = loss_criterion(out_price, Y_train_batch[b])
                 loss.backward()  
                 optimizer.step()
                 training_loss += loss.item()
-
-                # evaluate the model on the test set after training
-                with torch.no_grad():
-                    model.eval()
-                    _, out_test_price = model(adj, features, test_index_p[b])
-                    val_target = Y_test_batch[b].cpu().numpy()
-                    val_predict = out_test_price.detach().cpu().numpy()
-                    #print("val_predict", val_predict)
-                    #print("val_target", val_target)
-                    mse, mae, rmse, mape = score(val_predict, val_target)
-                    mse_list += mse
-                    mae_list += mae
-                    rmse_list += rmse
-                    mape_list += mape
-                    # we can't use the pre_error function because the val_target is not a list
-                    val_pred, val_tar = None, None
-                    if i == 9999 or i == 0:
-                        '''
-                        # save val predict and val target
-                        # load scaler.pkl to get the original value
-                        scaler = joblib.load(config.data_path + 'scaler.pkl')
-                        #print(val_predict.shape, val_target.shape)
-                        # make the shape be 1, 217, 339 so the last columnt is the value
-                        padding = np.zeros((val_predict.shape[0], val_predict.shape[1], 338))
-                        val_predict = np.concatenate((padding, val_predict), axis=2)
-                        val_target = np.concatenate((padding, val_target), axis=2)
-                        # apply the inverse transform to each dimension
-                        for j in range(val_predict.shape[0]):
-                            val_predict[j] = scaler.inverse_transform(val_predict[j])
-                            val_target[j] = scaler.inverse_transform(val_target[j])
-                        val_predict = val_predict[:, :, -1]
-                        val_target = val_target[:, :, -1]
-                        '''
-                        scaler = joblib.load(config.data_path + 'scaler_price.pkl')
-                        # apply the inverse transform to each dimension
-                        for j in range(val_predict.shape[0]):
-                            val_predict[j] = scaler.inverse_transform(val_predict[j])
-                            val_target[j] = scaler.inverse_transform(val_target[j])                      
-                        # concatenate the val_pred and val_tar
-                        if val_pred is None:
-                            val_pred = val_predict
-                            val_tar = val_target
-                        else:
-                            val_pred = np.concatenate((val_pred, val_predict), axis=0)
-                            val_tar = np.concatenate((val_tar, val_target), axis=0)
-            if val_pred is not None:
-                np.save(config.result_path + 'predictions/' + 'pred_time' + str(cur_month) + '_epoch' + str(i) + '.npy', val_pred)
-                np.save(config.result_path + 'predictions/' + 'target_time' + str(cur_month) + '_epoch' + str(i) + '.npy', val_tar)
-                del val_pred, val_tar
-            end_time = time.time()
-            cost_time = end_time - start_time
-            
             avg_training_loss = training_loss / batch_num
             logger.log_training(i, avg_training_loss)
-            mse = mse_list / batch_num
-            mae = mae_list / batch_num
-            rmse = rmse_list / batch_num
-            mape = mape_list / batch_num
+            if not evaluation.should_eval(i, avg_training_loss):
+                continue
+
+            # the epoch is selected on the validation houses, the test houses are only reported
+            with torch.no_grad():
+                model.eval()
+                _, out_valid_price = model(adj, features, valid_index_m)
+                _, out_test_price = model(adj, features, test_index_m)
+                val_target = Y_test.cpu().numpy()
+                val_predict = out_test_price.detach().cpu().numpy()
+            valid_mse, valid_mae, valid_rmse, valid_mape = score(out_valid_price.cpu().numpy(), Y_valid.cpu().numpy())
+            logger.log_validation(i, valid_mse, valid_mae, valid_rmse, valid_mape)
+            mse, mae, rmse, mape = score(val_predict, val_target)
+            cost_time = time.time() - start_time
             logger.log_testing(i, mse, mae, rmse, mape, cost_time)
+            if evaluation.update(i, valid_mse):
+                # parameters of the best epoch, the checkpoint of the month
+                best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            if i == 0 or i == train_epoch - 1 or evaluation.stop:
+                # save val predict and val target, with the original prices
+                for j in range(val_predict.shape[0]):
+                    val_predict[j] = scaler.inverse_transform(val_predict[j])
+                    val_target[j] = scaler.inverse_transform(val_target[j])
+                np.save(config.result_path + 'predictions/' + 'pred_time' + str(cur_month) + '_epoch' + str(i) + '.npy', val_predict)
+                np.save(config.result_path + 'predictions/' + 'target_time' + str(cur_month) + '_epoch' + str(i) + '.npy', val_target)
+            if evaluation.stop:
+                print('No improvement of the validation MSE in {} evaluations, stopping month {} at epoch {}.'.format(
+                    evaluation.patience, cur_month, i))
+                break
+        print('Best validation MSE of month {}: {} at epoch {}'.format(cur_month, evaluation.best, evaluation.best_epoch))
+        if best_state is not None:
+            model.load_state_dict(best_state)
         torch.save(model.state_dict(), config.result_path + 'model_saved/' + 'time' + str(cur_month) + '.pkl')
 
 
@@ -4,7 +4,10 @@ from sklearn.metrics import mean_absolute_error
 from sklearn.metrics import r2_score
 import numpy as np
 import os
+from adj_store import load_adjacency
+from cache import DataCache
 from data import *
+from models import TiledAdjacency
 
 
 def score(y_predict, y_target):
@@ -44,43 +47,115 @@ def price_str(val_predict, val_target, val_listprice):
                  ', ' + str(abs(val_listprice[k,0]-val_target[k,0])) + '\n'
     return w_str
 
-def prepare_data(config):
-    if True:
-    #not os.path.exists(config.data_path + 'features.npy') \
-    #        or not os.path.exists(config.data_path + 'labels.npy') \
-    #        or not os.path.exists(config.data_path + 'train_index.npy') \
-    #        or not os.path.exists(config.data_path + 'test_index.npy'):
-        print("Config: ", config.concat)
-        features, labels, train_index, test_index = \
-            load_data(path=config.data_path, month_len=config.seq_len, house_size=config.house_size, dataset=config.dataset, concat=config.concat)
-        print('Data is generated.')
-    else:
-        features = np.load(config.data_path + 'features.npy')
-        labels = np.load(config.data_path + 'labels.npy')
-        train_index = np.load(config.data_path + 'train_index.npy', allow_pickle=True)
-        test_index = np.load(config.data_path + 'test_index.npy', allow_pickle=True)
-        print('Data is loaded.')
-    adj = []
-    tile_num = config.seq_len
-
+def prepare_data(config, valid_ratio=0):
+    '''
+    valid_ratio: share of the training houses held out for validation, the same houses in every month.
+        With valid_ratio > 0 the validation index is returned after the training index
+    '''
     if config.yearly:
         names = ['adjacency_house_yearly.npy', 'adjacency_geo_yearly.npy']
+        tile_num = config.seq_len
     else:
         names = ['adjacency_house_monthly.npy', 'adjacency_geo_monthly.npy']
-        tile_num /= 12
-        tile_num = int(tile_num)
-    for name in names:
-        a = np.load(config.data_path + name)
-        a = np.tile(a, (tile_num, tile_num))
-        adj.append(a)
-    #adj = [np.load(config.data_path + 'adjacency_house.npy'), np.load(config.data_path + 'adjacency_geo.npy')]
-    
-    # not working
-    #adj = [np.load(config.data_path + 'adjacency_house.npz')['data'], np.load(config.data_path + 'adjacency_geo.npz')['data']]
+        tile_num = int(config.seq_len / 12)
+    # the sparse containers of the meta paths, or the older dense .npy files
+    adjacency = [load_adjacency(config.data_path + name, mmap_mode='r') for name in names]
+
+    cache, entry = None, None
+    if config.cache:
+        cache = DataCache(config.data_path + 'cache/', config.cache_max_bytes, config.cache_max_age)
+        # the adjacency fingerprints cover the meta path columns and sigma they were built with
+        params = {'dataset': config.dataset, 'seq_len': config.seq_len, 'house_size': config.house_size,
+                  'concat': config.concat, 'yearly': config.yearly, 'tiled': True,
+                  'adjacency': [a.fingerprint for a in adjacency]}
+        key = cache.key([config.data_path + config.dataset], params)
+        entry = cache.load(key)
+        if entry is not None:
+            adj = [entry['adj_{}'.format(i)] for i in range(len(names))]
+            features, labels = entry['features'], entry['labels']
+            train_index, test_index = entry['train_index'], entry['test_index']
+            print('Data is loaded from cache {}.'.format(key))
+    if entry is None:
+        print("Config: ", config.concat)
+        features, labels, train_index, test_index = \
+            load_data(path=config.data_path, month_len=config.seq_len, house_size=config.house_size, dataset=config.dataset, concat=config.concat)
+        print('Data is generated.')
+        # one houses * houses matrix per meta path, tiled over the months by TiledAdjacency
+        adj = [a.toarray(0) for a in adjacency]
+        if cache is not None:
+            arrays = {'features': features, 'labels': labels, 'train_index': train_index, 'test_index': test_index}
+            arrays.update({'adj_{}'.format(i): a for i, a in enumerate(adj)})
+            cache.save(key, arrays, params)
+    adj = TiledAdjacency(np.stack(adj), tile_num)
     print('adj: ' + str(adj[0].shape))
     print('features: ' + str(features.shape))
     print('labels: ' + str(labels.shape))
     print('train_index: ' + str(train_index.shape))
     print('test_index: ' + str(test_index.shape))
+    if valid_ratio > 0:
+        train_index, valid_index = split_valid_index(train_index, valid_ratio)
+        print('valid_index: ' + str(valid_index.shape))
     print('***********************************************************')
-    return adj, features, labels, train_index, test_index
\ No newline at end of file
+    if valid_ratio > 0:
+        return adj, features, labels, train_index, valid_index, test_index
+    return adj, features, labels, train_index, test_index
+
+
+def split_valid_index(train_index, valid_ratio, seed=0):
+    '''
+    train_index: months * houses
+    return: the training and the validation index, a fixed random share of the house columns
+    '''
+    houses = train_index.shape[1]
+    valid_size = max(1, int(round(houses * valid_ratio)))
+    order = np.random.RandomState(seed).permutation(houses)
+    valid, train = np.sort(order[:valid_size]), np.sort(order[valid_size:])
+    return train_index[:, train], train_index[:, valid]
+
+class EvalScheduler:
+    def __init__(self, epochs, every=10, plateau=None, patience=None, min_delta=0.0):
+        '''
+        Decides the epochs the model is evaluated and when the training stops early
+        epochs: epochs of the month, the first and the last one are always evaluated
+        every: evaluate every `every` epochs, None for the month end only
+        plateau: also evaluate when the training loss did not improve for this many epochs
+        patience: stop after this many evaluations without a better validation mse, None never stops
+        min_delta: smallest decrease of a loss that counts as an improvement
+        '''
+        self.epochs = epochs
+        self.every = every
+        self.plateau = plateau
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = np.inf
+        self.best_epoch = None
+        self.bad_evals = 0
+        self.best_train = np.inf
+        self.bad_epochs = 0
+
+    def should_eval(self, epoch, train_loss):
+        if train_loss < self.best_train - self.min_delta:
+            self.best_train, self.bad_epochs = train_loss, 0
+        else:
+            self.bad_epochs += 1
+        due = epoch == 0 or epoch == self.epochs - 1 or (self.every is not None and epoch % self.every == 0) or \
+            (self.plateau is not None and self.bad_epochs >= self.plateau)
+        if due:
+            # a plateau is counted from the last evaluation
+            self.bad_epochs = 0
+        return due
+
+    def update(self, epoch, metric):
+        '''
+        metric: validation metric of the evaluation, lower is better
+        return: True if it is the best so far
+        '''
+        if metric < self.best - self.min_delta:
+            self.best, self.best_epoch, self.bad_evals = metric, epoch, 0
+            return True
+        self.bad_evals += 1
+        return False
+
+    @property
+    def stop(self):
+        return self.patience is not None and self.bad_evals >= self.patience
@@ -5,10 +5,12 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 import argparse
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.externals import joblib 
+from adj_store import save_adjacency
 
 
 def distance(lon1, lat1, lon2, lat2):
@@ -25,24 +27,57 @@ def distance(lon1, lat1, lon2, lat2):
     return d
 
 # It is incorrect with respect to community level. Change it later.
-def create_adj(df, time_limit=3, distance_limit=1):
+def create_adj(df, time_limit=3, distance_limit=1, block_size=4096):
     '''
     df: dataframe containing the data
+    block_size: number of rows of adj_h computed at once, bounds the memory of the
+        intermediate product
+    return: (adj_h, adj_g) upper triangular float32 csr matrices, adj_h[i, j] = 1 for
+        the sales i <= j of the same year at most time_limit months apart, adj_g[i, j] = 1
+        for the pairs of adj_h at most distance_limit km apart
+
+    Instead of comparing every pair of rows, the sales are bucketed by (year, month).
+    adj_h is the product of the 0/1 bucket incidence of the sales with a band matrix
+    joining the buckets of the same year at most time_limit months apart. adj_g only
+    looks at the pairs within distance_limit that a KD-tree of the sales of the year
+    returns, and keeps those within the month window.
     '''
     l = len(df)
-    adj_h = np.zeros((l, l), dtype=np.float64)
-    adj_g = np.zeros((l, l), dtype=np.float64)
-    for i in range(l):
-        row1 = df.iloc[i]
-        for j in range(i, l):
-            row2 = df.iloc[j]
-            if row1['year'] == row2['year'] and abs(row1['month'] - row2['month']) <= time_limit:
-                adj_h[i][j] = 1
-                dist = distance(row1['lon_x'], row1['lat_y'], row2['lon_x'], row2['lat_y'])
-                if dist <= distance_limit:
-                    adj_g[i][j] = 1                
-    return adj_h, adj_g
+    year = df['year'].values
+    month = df['month'].values.astype(np.int64)
+    lon = df['lon_x'].values.astype(np.float64)
+    lat = df['lat_y'].values.astype(np.float64)
 
+    codes, buckets = pd.MultiIndex.from_arrays([year, month]).factorize()
+    incidence = sparse.csr_matrix((np.ones(l, dtype=np.float32), (np.arange(l), codes)), shape=(l, len(buckets)))
+    b_year = buckets.get_level_values(0).values
+    b_month = buckets.get_level_values(1).values.astype(np.int64)
+    band = sparse.csr_matrix((b_year[:, np.newaxis] == b_year[np.newaxis, :]) &
+                             (np.abs(b_month[:, np.newaxis] - b_month[np.newaxis, :]) <= time_limit), dtype=np.float32)
+    window = (incidence @ band).tocsr()
+    incidence_t = incidence.T.tocsc()
+    adj_h = []
+    for start in range(0, l, block_size):
+        stop = min(start + block_size, l)
+        adj_h.append(sparse.triu(window[start:stop] @ incidence_t, k=start, format='csr'))
+    adj_h = sparse.vstack(adj_h, format='csr') if adj_h else sparse.csr_matrix((0, 0), dtype=np.float32)
+
+    rows, cols = [np.arange(l)], [np.arange(l)]
+    # KD-tree on points of the unit sphere, the chord length grows with the arc length
+    chord = 2 * np.sin(min(distance_limit / (2 * 6371), np.pi / 2))
+    for y in pd.unique(year):
+        idx = np.flatnonzero(year == y)
+        phi, lam = np.radians(lat[idx]), np.radians(lon[idx])
+        xyz = np.stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)), axis=1)
+        pairs = cKDTree(xyz).query_pairs(chord * (1 + 1e-9), output_type='ndarray')
+        i, j = idx[pairs[:, 0]], idx[pairs[:, 1]]
+        keep = (np.abs(month[i] - month[j]) <= time_limit) & \
+            (distance(lon[i], lat[i], lon[j], lat[j]) <= distance_limit)
+        rows.append(np.minimum(i, j)[keep])
+        cols.append(np.maximum(i, j)[keep])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    adj_g = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(l, l))
+    return adj_h, adj_g
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -80,8 +115,8 @@ if __name__ == '__main__':
         print("The true shape of adjacency matrix for house meta path is {}".format(Ah.shape)) 
         print("The true shape of adjacency matrix for geo meta path is {}".format(Ag.shape))
 
-        np.save('./data/adjacency_house.npy', Ah)
-        np.save('./data/adjacency_geo.npy', Ag)
+        save_adjacency('./data/adjacency_house', Ah, names=['house'], dtype=np.float32)
+        save_adjacency('./data/adjacency_geo', Ag, names=['geo'], dtype=np.float32)
 
     # prepare data for training using one-hot encoding
     df = pd.get_dummies(df)
@@ -1,4 +1,5 @@
 import torch
+from adj_store import load_adjacency
 
 
 
@@ -32,10 +33,8 @@ if __name__ == '__main__':
     test_loader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=False)
 
     # Load adjacencies
-    adj_house = np.load(config.data_path + 'adj_house.npy')
-    adj_house = torch.from_numpy(adj).float().to(device)
-    adj_geo = np.load(config.data_path + 'adj_geo.npy')
-    adj_geo = torch.from_numpy(adj).float().to(device)
+    adj_house = load_adjacency(config.data_path + 'adjacency_house').torch_sparse(0).float().to(device)
+    adj_geo = load_adjacency(config.data_path + 'adjacency_geo').torch_sparse(0).float().to(device)
 
     # Define others
     logger = Logger()
@@ -1,9 +1,11 @@
 import os
 from time import time
-import networkx as nx
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from adjacency import update_adj, verify_update
+from adj_build import build_dice
+from adj_store import load_adjacency, save_adjacency
 import matplotlib.pyplot as plt
 import argparse
 from sklearn.decomposition import PCA
@@ -11,44 +13,6 @@ from sklearn.preprocessing import MinMaxScaler
 import joblib 
 
 
-def construct_graph_from_df(df, G=None, hid='id'):
-    '''
-    df: dataframe containing the data
-    G: networkx graph to which the data is to be added
-    '''
-    if G is None:
-        G = nx.Graph()
-    l = list(df.columns)
-    done_house = []
-    l.remove(hid)
-    for _, row in df.iterrows():
-        if row[hid] in done_house:
-            continue
-        G.add_node(row[hid])
-        done_house.append(row[hid])
-        for col in l:
-            G.add_node(row[col])
-            G.add_edge(row[hid], row[col])
-    return G
-
-# create adjacency matrix following the equaation in paper
-# https://arxiv.org/abs/2008.05880
-def create_adj(G, id_list):
-    '''
-    G: networkx graph for the meta path
-    id_list: list of ids for which adjacency matrix is to be created
-    '''
-    adj = np.zeros((len(id_list), len(id_list)), dtype=np.float64)
-    for i, h1 in enumerate(id_list):
-        for j, h2 in enumerate(id_list):
-            l1 = [t[1] for t in list(G.edges(h1))]
-            l2 = [t[1] for t in list(G.edges(h2))]
-            den = len(l1) + len(l2)
-            num = 2 * len(list(set(l1) & set(l2)))
-            similarity = num / den
-            adj[i][j] = similarity
-    return adj
-
 def apply_PC(A):
     '''
     A: adjacency matrix
@@ -58,12 +22,12 @@ def apply_PC(A):
     return pca.transform(A)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--data_path" , type=str, default='./data/kc.csv')
-    args = parser.parse_args()
-
-    df = pd.read_csv(args.data_path, index_col=False, encoding="utf8")
+def read_data(data_path):
+    '''
+    data_path: csv file of house sales
+    return: dataframe of the meta path attributes
+    '''
+    df = pd.read_csv(data_path, index_col=False, encoding="utf8")
     df = df.dropna()
     
     # extract the from timestamp
@@ -80,10 +44,50 @@ if __name__ == '__main__':
     imp_features = ['id', 'grade', 'waterfront', 'sqft_living'] #, 'zipcode', 'view' 'year_old']
     df = df[imp_features]
     df = df.reset_index(drop=True)
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path" , type=str, default='./data/kc.csv')
+    # update the saved adjacency with the sales of delta_path instead of rebuilding it
+    parser.add_argument("--delta_path" , type=str, default=None)
+    # csv with the id column of the delisted houses
+    parser.add_argument("--delisted_path" , type=str, default=None)
+    # check the update against a full rebuild on the sales of data_path and delta_path, for small datasets
+    parser.add_argument("--verify_update", action='store_true')
+    # number of processes building the adjacency
+    parser.add_argument("--processes", type=int, default=1)
+    # similarity join, only keep similarities of at least threshold and the top_k of every house
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--top_k", type=int, default=None)
+    args = parser.parse_args()
 
-    G = construct_graph_from_df(df)
-    # Create adjacency matrix for each meta path
-    A = create_adj(G, df.id.tolist())
+    if args.delta_path is not None:
+        adj = load_adjacency('./data/adjacency_luce')
+        if adj.attributes is None:
+            raise ValueError('./data/adjacency_luce has no attributes, rebuild it without --delta_path first')
+        if adj.join is None:
+            raise ValueError('./data/adjacency_luce does not record its similarity join, rebuild it without --delta_path first')
+        # update_adj recomputes the affected pairs without a threshold or top_k
+        if any(v is not None for v in adj.join.values()):
+            raise ValueError('./data/adjacency_luce was built with the similarity join {}, rebuild it without '
+                             '--threshold and --top_k to update it'.format(adj.join))
+        delta = read_data(args.delta_path)
+        removed = pd.read_csv(args.delisted_path).id.tolist() if args.delisted_path is not None else []
+        if args.verify_update:
+            diff = verify_update(read_data(args.data_path), delta, removed, hid='id')
+            print('The update matches the full rebuild, largest difference {}'.format(diff))
+        # only the new sales and the delisted houses are recomputed
+        A, id_list, df = update_adj(adj[0], adj.node_ids, adj.attributes, delta, removed, hid='id')
+        save_adjacency('./data/adjacency_luce', A, names=['luce'], node_ids=np.array(id_list), attributes=df,
+                       join=adj.join)
+    else:
+        df = read_data(args.data_path)
+        id_list = df.id.tolist()
+        # Create adjacency matrix for each meta path
+        A = build_dice('./data/adjacency_luce', [df], id_list, hid='id', names=['luce'], node_ids=np.array(id_list),
+                       attributes=df, threshold=args.threshold,
+                       top_k=args.top_k, processes=args.processes)[0]
 
-    print("The true shape of adjacency matrix for house meta path is {}".format(A.shape)) 
-    np.save('./data/adjacency_luce.npy', A)
\ No newline at end of file
+    print("The true shape of adjacency matrix for house meta path is {}".format(A.shape)) 
\ No newline at end of file
@@ -0,0 +1,454 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import torch
+from scipy import sparse
+
+
+"""
+On-disk container for the adjacency matrices of one or more meta paths.
+
+A container is a directory holding one CSR matrix per meta path
+({k}_indptr.npy, {k}_indices.npy, {k}_data.npy), the node ordering (nodes.npy),
+optionally the attribute table the adjacency was built from (attributes.pkl,
+needed by adjacency.update_adj) and meta.json with the meta path names, number of nodes, dtype, the
+parameters of the similarity join the matrices were built with and a content fingerprint. load_adjacency is the single entry point of the trainers: it also
+reads the legacy dense .npy files and scipy .npz files, so old preprocessing
+outputs keep working. None of the conversions below build the dense N*N array
+except toarray.
+
+With mmap_mode the parts of a container stay memory-mapped. block(start, stop)
+then only reads indptr[start:stop + 1] and the column indices and values of the
+rows start:stop, so the memory of batched training is bounded by the batch and
+not by N^2. A dense .npy file loaded with mmap_mode stays mapped as well and
+block reads m[start:stop, start:stop] of it. concat and select keep the parts
+mapped, the full scipy matrices are only built when a matrix is indexed with
+adj[i].
+"""
+
+FORMAT_VERSION = 1
+# rows of a dense .npy file read at once
+DENSE_BLOCK = 1024
+
+
+def _canonical(matrix, dtype):
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix, dtype=dtype)
+    else:
+        matrix = sparse.csr_matrix(np.asarray(matrix, dtype=dtype))
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    matrix.indptr = matrix.indptr.astype(np.int64)
+    matrix.indices = matrix.indices.astype(np.int32)
+    return matrix
+
+
+def _csr_block(indptr, indices, data, start, stop):
+    '''
+    rows and columns start:stop of a csr matrix given by its parts, only the
+    parts of the rows start:stop are read
+    '''
+    rowptr = np.asarray(indptr[start:stop + 1], dtype=np.int64)
+    lo, hi = rowptr[0], rowptr[-1]
+    cols = np.asarray(indices[lo:hi])
+    values = np.asarray(data[lo:hi])
+    keep = (cols >= start) & (cols < stop)
+    # count the kept entries of every row to rebuild indptr
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    rowptr = kept[rowptr - lo]
+    return sparse.csr_matrix((values[keep], (cols[keep] - start).astype(np.int32), rowptr),
+                             shape=(stop - start, stop - start))
+
+
+class _DensePart:
+    '''
+    one meta path of a memory-mapped dense .npy file, used as a part of a container
+    in place of (indptr, indices, data). Only the rows and columns of a block are read
+    '''
+
+    def __init__(self, array, dtype):
+        self.array = array
+        self.dtype = np.dtype(dtype)
+
+    def block(self, start, stop, col_start=None, col_stop=None):
+        '''
+        csr matrix of the rows start:stop and the columns col_start:col_stop, start:stop by default
+        '''
+        col_start = start if col_start is None else col_start
+        col_stop = stop if col_stop is None else col_stop
+        # DENSE_BLOCK rows at a time, the dense rows of the whole block are never in memory
+        blocks = [sparse.csr_matrix(np.asarray(self.array[s:min(s + DENSE_BLOCK, stop), col_start:col_stop], dtype=self.dtype))
+                  for s in range(start, stop, DENSE_BLOCK)]
+        m = sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, col_stop - col_start), dtype=self.dtype)
+        m.indptr = m.indptr.astype(np.int64)
+        m.indices = m.indices.astype(np.int32)
+        return m
+
+
+def _read_block(part, start, stop):
+    '''
+    rows and columns start:stop of a part of a container
+    '''
+    if isinstance(part, _DensePart):
+        return part.block(start, stop)
+    return _csr_block(*part, start, stop)
+
+
+def _row_blocks(part, num_nodes):
+    '''
+    the rows 0:num_nodes of a part as consecutive csr row blocks
+    '''
+    if isinstance(part, _DensePart):
+        for start in range(0, num_nodes, DENSE_BLOCK):
+            yield part.block(start, min(start + DENSE_BLOCK, num_nodes), 0, num_nodes)
+    else:
+        yield _csr_block(*part, 0, num_nodes)
+
+
+class SparseAdjacency:
+    def __init__(self, matrices, names=None, node_ids=None, dtype=np.float64, attributes=None, join=None):
+        '''
+        matrices: one (N, N) matrix per meta path, dense or sparse. A single
+            matrix or a (meta_size, N, N) dense array is accepted as well
+        names: name of each meta path
+        node_ids: id of the house of every row, in row order
+        attributes: dataframe of the meta path attributes the matrices were built from
+        join: parameters of the similarity join the matrices were built with, e.g.
+            {'threshold': None, 'top_k': None} for all pairs, None if unknown
+        '''
+        if sparse.issparse(matrices) or (isinstance(matrices, np.ndarray) and matrices.ndim == 2):
+            matrices = [matrices]
+        matrices = [_canonical(m, dtype) for m in matrices]
+        num_nodes = matrices[0].shape[0] if matrices else 0
+        for m in matrices:
+            if m.shape != (num_nodes, num_nodes):
+                raise ValueError('all meta paths need the same square shape, got {}'.format(
+                    [m.shape for m in matrices]))
+        names = list(names) if names is not None else [str(i) for i in range(len(matrices))]
+        if len(names) != len(matrices):
+            raise ValueError('{} names for {} meta paths'.format(len(names), len(matrices)))
+        node_ids = np.asarray(node_ids) if node_ids is not None else None
+        if node_ids is not None and len(node_ids) != num_nodes:
+            raise ValueError('{} node ids for {} nodes'.format(len(node_ids), num_nodes))
+        self._init([(m.indptr, m.indices, m.data) for m in matrices], num_nodes, names, node_ids, dtype)
+        self._matrices = matrices
+        self.attributes = attributes
+        self.join = join
+
+    def _init(self, parts, num_nodes, names, node_ids, dtype, fingerprint=None):
+        '''
+        parts: (indptr, indices, data) of every meta path, numpy arrays or memmaps. The
+            parts may hold more rows and columns than num_nodes, they are cut when read
+        '''
+        self._parts = parts
+        self.num_nodes = num_nodes
+        self.names = names
+        self.node_ids = node_ids
+        self.dtype = np.dtype(dtype)
+        self._fingerprint = fingerprint
+        self._matrices = None
+        self.attributes = None
+        self.join = None
+
+    @classmethod
+    def _from_parts(cls, parts, num_nodes, names, node_ids, dtype, fingerprint=None):
+        adj = cls.__new__(cls)
+        adj._init(parts, num_nodes, names, node_ids, dtype, fingerprint)
+        return adj
+
+    @property
+    def matrices(self):
+        '''
+        scipy csr matrix of every meta path, read into memory on first use
+        '''
+        if self._matrices is None:
+            self._matrices = [_read_block(part, 0, self.num_nodes) for part in self._parts]
+        return self._matrices
+
+    @property
+    def meta_size(self):
+        return len(self._parts)
+
+    @property
+    def shape(self):
+        return (self.meta_size, self.num_nodes, self.num_nodes)
+
+    def __len__(self):
+        return self.meta_size
+
+    def __getitem__(self, i):
+        return self.matrices[i]
+
+    @property
+    def fingerprint(self):
+        '''
+        sha1 of the node ordering and of every meta path matrix
+        '''
+        if self._fingerprint is None:
+            h = hashlib.sha1()
+            h.update(json.dumps({'names': self.names, 'num_nodes': self.num_nodes,
+                                 'dtype': self.dtype.str}, sort_keys=True).encode())
+            if self.node_ids is not None and self.node_ids.dtype == object:
+                # the bytes of an object array are pointers, hash the ids as text
+                h.update('\n'.join(map(str, self.node_ids)).encode())
+            elif self.node_ids is not None:
+                h.update(np.ascontiguousarray(self.node_ids).tobytes())
+            # fixed index dtypes, scipy picks its own when a matrix is rebuilt
+            if self._matrices is not None or not any(isinstance(p, _DensePart) for p in self._parts):
+                for m in self.matrices:
+                    for part in (m.indptr.astype(np.int64), m.indices.astype(np.int32), m.data):
+                        h.update(np.ascontiguousarray(part).tobytes())
+            else:
+                # the same bytes, read in row blocks so that a dense file is never fully in memory
+                for p in self._parts:
+                    counts = [np.diff(b.indptr) for b in _row_blocks(p, self.num_nodes)]
+                    h.update(np.concatenate([[0]] + counts).cumsum().astype(np.int64).tobytes())
+                    for b in _row_blocks(p, self.num_nodes):
+                        h.update(np.ascontiguousarray(b.indices.astype(np.int32)).tobytes())
+                    for b in _row_blocks(p, self.num_nodes):
+                        h.update(np.ascontiguousarray(b.data).tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def save(self, path):
+        '''
+        path: directory of the container, created if missing
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for k, m in enumerate(self.matrices):
+            np.save(os.path.join(path, '{}_indptr.npy'.format(k)), m.indptr.astype(np.int64))
+            np.save(os.path.join(path, '{}_indices.npy'.format(k)), m.indices.astype(np.int32))
+            np.save(os.path.join(path, '{}_data.npy'.format(k)), m.data)
+        if self.node_ids is not None:
+            np.save(os.path.join(path, 'nodes.npy'), self.node_ids)
+        if self.attributes is not None:
+            self.attributes.to_pickle(os.path.join(path, 'attributes.pkl'))
+        meta = {'format': 'csr', 'version': FORMAT_VERSION, 'names': self.names,
+                'num_nodes': self.num_nodes, 'dtype': self.dtype.str,
+                'nnz': [int(m.nnz) for m in self.matrices],
+                'has_nodes': self.node_ids is not None, 'has_attributes': self.attributes is not None,
+                'join': self.join, 'fingerprint': self.fingerprint}
+        # meta.json is written last, a container without it is incomplete
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+
+    @classmethod
+    def load(cls, path, verify=False, mmap_mode=None):
+        '''
+        path: directory of the container
+        verify: recompute the fingerprint and compare it with the stored one
+        mmap_mode: passed to np.load, 'r' keeps the parts on disk
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        parts = []
+        for k in range(len(meta['names'])):
+            parts.append(tuple(np.load(os.path.join(path, '{}_{}.npy'.format(k, part)), mmap_mode=mmap_mode)
+                               for part in ('indptr', 'indices', 'data')))
+        node_ids = None
+        if meta['has_nodes']:
+            try:
+                node_ids = np.load(os.path.join(path, 'nodes.npy'), mmap_mode=mmap_mode)
+            except ValueError:
+                # ids stored as python objects can not be mapped
+                node_ids = np.load(os.path.join(path, 'nodes.npy'), allow_pickle=True)
+        adj = cls._from_parts(parts, meta['num_nodes'], meta['names'], node_ids, meta['dtype'], meta['fingerprint'])
+        if meta.get('has_attributes', False):
+            adj.attributes = pd.read_pickle(os.path.join(path, 'attributes.pkl'))
+        # containers written before the join was recorded have no join
+        adj.join = meta.get('join')
+        if verify:
+            adj._fingerprint = None
+            if adj.fingerprint != meta['fingerprint']:
+                raise ValueError('fingerprint mismatch for {}, the container is corrupted'.format(path))
+        return adj
+
+    @classmethod
+    def concat(cls, adjs, num_nodes=None):
+        '''
+        adjs: containers to stack along the meta path axis
+        num_nodes: keep the first num_nodes nodes, by default the smallest container size
+        '''
+        if num_nodes is None:
+            num_nodes = min(a.num_nodes for a in adjs)
+        if num_nodes > min(a.num_nodes for a in adjs):
+            raise ValueError('can not keep {} nodes, the smallest container has {}'.format(
+                num_nodes, min(a.num_nodes for a in adjs)))
+        parts, names = [], []
+        for a in adjs:
+            parts.extend(a._parts)
+            names.extend(a.names)
+        node_ids = adjs[0].node_ids[:num_nodes] if adjs[0].node_ids is not None else None
+        return cls._from_parts(parts, num_nodes, names, node_ids, adjs[0].dtype)
+
+    def select(self, ids):
+        '''
+        container with the meta paths ids only
+        '''
+        return self._from_parts([self._parts[k] for k in ids], self.num_nodes, [self.names[k] for k in ids],
+                                self.node_ids, self.dtype)
+
+    def toarray(self, i=None):
+        '''
+        dense (N, N) array of meta path i, or (meta_size, N, N) of all of them
+        '''
+        if i is not None:
+            return self.matrices[i].toarray()
+        return np.stack([m.toarray() for m in self.matrices], axis=0)
+
+    def block(self, start, stop):
+        '''
+        container of the nodes start:stop, i.e. the rows and columns start:stop of every meta path
+        '''
+        start, stop = max(start, 0), min(stop, self.num_nodes)
+        node_ids = np.asarray(self.node_ids[start:stop]) if self.node_ids is not None else None
+        matrices = [_read_block(part, start, stop) for part in self._parts]
+        adj = self._from_parts([(m.indptr, m.indices, m.data) for m in matrices], stop - start,
+                               self.names, node_ids, self.dtype)
+        adj._matrices = matrices
+        return adj
+
+    def nonzero(self):
+        '''
+        return: (index, values) where index is (3, E) of (meta path, row, col),
+            the same as np.vstack(A.nonzero()) and A[A.nonzero()] of the stacked dense array
+        '''
+        index, values = [], []
+        for k, m in enumerate(self.matrices):
+            row = np.repeat(np.arange(m.shape[0], dtype=np.int64), np.diff(m.indptr))
+            index.append(np.vstack((np.full(m.nnz, k, dtype=np.int64), row, m.indices.astype(np.int64))))
+            values.append(m.data)
+        if not index:
+            return np.zeros((3, 0), dtype=np.int64), np.zeros(0, dtype=self.dtype)
+        return np.concatenate(index, axis=1), np.concatenate(values)
+
+    def edge_index(self, i=0):
+        '''
+        return: (edge_index, edge_weight) torch tensors of meta path i, edge_index is (2, E) of (row, col)
+        '''
+        m = self.matrices[i].tocoo()
+        edge_index = torch.from_numpy(np.vstack((m.row, m.col)).astype(np.int64))
+        edge_weight = torch.from_numpy(m.data.astype(np.float32))
+        return edge_index, edge_weight
+
+    def torch_sparse(self, i=0):
+        '''
+        return: torch sparse coo tensor of meta path i
+        '''
+        edge_index, edge_weight = self.edge_index(i)
+        return torch.sparse_coo_tensor(edge_index, edge_weight, (self.num_nodes, self.num_nodes)).coalesce()
+
+    def dgl_graph(self, i=None):
+        '''
+        return: dgl graph with the edges of meta path i (all meta paths when None),
+            the weights are stored as edata['weight'], edata['weight_1'], ... with
+            zeros for the pairs that are not connected in a meta path
+        '''
+        import dgl
+        ids = range(self.meta_size) if i is None else [i]
+        union = sum(self.matrices[k] != 0 for k in ids).tocoo()
+        g = dgl.graph((torch.from_numpy(union.row.astype(np.int64)), torch.from_numpy(union.col.astype(np.int64))),
+                      num_nodes=self.num_nodes)
+        for j, k in enumerate(ids):
+            weight = np.asarray(self.matrices[k][union.row, union.col]).flatten()
+            g.edata['weight' if j == 0 else 'weight_{}'.format(j)] = torch.from_numpy(weight)
+        return g
+
+
+class BatchGraphs:
+    '''
+    The graph list `a` the GTN models take for every batch, [(edge_index, edge_weight), ...],
+    built once before training as torch tensors on the device. The graph does not
+    change between epochs, so the epochs only index the cache instead of slicing the
+    adjacency and copying it to the device again.
+    '''
+
+    def __init__(self, graphs, batch_size):
+        self.graphs = graphs
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def __getitem__(self, batch):
+        '''
+        batch: first row of the batch, as in range(0, rows, batch_size)
+        '''
+        return self.graphs[batch // self.batch_size]
+
+    @classmethod
+    def induced(cls, adj, start, stop, batch_size, device=None):
+        '''
+        subgraph of the nodes of every batch of rows start:stop, the (3, E) index of
+        (meta path, row, col) of SparseAdjacency.nonzero
+        adj: SparseAdjacency
+        '''
+        graphs = []
+        for s in range(start, stop, batch_size):
+            edge_index, edge_weight = adj.block(s, min(s + batch_size, stop)).nonzero()
+            edge_index = torch.from_numpy(edge_index).to(torch.long)
+            edge_weight = torch.from_numpy(edge_weight).to(torch.float32)
+            graphs.append([(edge_index.to(device), edge_weight.to(device))])
+        return cls(graphs, batch_size)
+
+    @classmethod
+    def edge_slices(cls, A, rows, batch_size):
+        '''
+        edges batch:batch + batch_size of every meta path, for every batch of rows 0:rows
+        A: list of (edge_index, edge_weight) of every meta path
+        '''
+        graphs = []
+        for s in range(0, rows, batch_size):
+            e = min(s + batch_size, rows)
+            graphs.append([(edge_index[:, s:e], edge_weight[s:e]) for edge_index, edge_weight in A])
+        return cls(graphs, batch_size)
+
+
+def save_adjacency(path, matrices, names=None, node_ids=None, dtype=np.float64, attributes=None, join=None):
+    '''
+    path: directory of the container
+    matrices: one matrix per meta path, see SparseAdjacency
+    '''
+    adj = SparseAdjacency(matrices, names=names, node_ids=node_ids, dtype=dtype, attributes=attributes, join=join)
+    adj.save(path)
+    return adj
+
+
+def _resolve(path):
+    if os.path.exists(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    for candidate in (stem, stem + '.npz', stem + '.npy'):
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError('no adjacency found at {} (tried the container, .npz and .npy)'.format(path))
+
+
+def load_adjacency(path, verify=False, mmap_mode=None):
+    '''
+    path: container directory, scipy .npz or dense .npy file. The extension may be
+        left out or point to an older format, e.g. data/adjacency_luce.npy finds the
+        container data/adjacency_luce when the .npy file is not there
+    verify: recompute the fingerprint of a container
+    mmap_mode: keep a container on disk, see SparseAdjacency.load. A dense .npy file
+        then stays memory-mapped and block(start, stop) only reads its rows and
+        columns start:stop, so it is never fully in memory
+    return: SparseAdjacency
+    '''
+    path = _resolve(path)
+    if os.path.isdir(path):
+        return SparseAdjacency.load(path, verify=verify, mmap_mode=mmap_mode)
+    if path.endswith('.npz'):
+        return SparseAdjacency(sparse.load_npz(path))
+    if mmap_mode is None:
+        return SparseAdjacency(np.load(path))
+    dense = np.load(path, mmap_mode=mmap_mode)
+    matrices = dense[np.newaxis] if dense.ndim == 2 else dense
+    if matrices.shape[1] != matrices.shape[2]:
+        raise ValueError('all meta paths need the same square shape, got {}'.format(matrices.shape[1:]))
+    return SparseAdjacency._from_parts([_DensePart(m, np.float64) for m in matrices], matrices.shape[1],
+                                       [str(i) for i in range(len(matrices))], None, np.float64)
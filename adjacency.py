@@ -0,0 +1,359 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+"""
+Meta path adjacency matrices following the equation in the LUCE paper
+https://arxiv.org/abs/2008.05880
+
+The similarity of two houses A and B is the Dice coefficient of the attribute
+values they are connected to in the meta path graph, 2|A & B| / (|A| + |B|).
+Instead of comparing every pair of houses in python, every house is encoded as a
+row of a sparse 0/1 incidence matrix (houses * attribute values). |A & B| for
+all pairs is then the sparse product incidence * incidence^T, which is computed
+block by block of rows so that memory stays bounded. The incidence matrix is
+built straight from the dataframe columns, without a networkx graph.
+
+Most pairs of houses share some common value, so the full Dice matrix is
+nearly dense. As a similarity join only the pairs of at least a threshold, or
+the top k of every house, are kept, and with a threshold only the pairs sharing
+one of their rarest values are compared at all.
+
+Geographic gaussian similarities use a spatial index, so only pairs of houses
+within a cutoff distance are evaluated and the result is stored sparse.
+"""
+
+
+def meta_incidence(df, id_list, hid='house'):
+    '''
+    df: dataframe with the house id column and the meta path attribute columns
+    id_list: list of ids for which the incidence matrix is to be created
+    hid: name of the house id column
+    return: csr matrix with one row per id in id_list, marking the neighbours of
+        the house in the meta path graph
+    '''
+    # the meta path graph only takes the first row of every house
+    df = df.drop_duplicates(subset=[hid], keep='first')
+    cols = [c for c in df.columns if c != hid]
+    n_houses = len(df)
+    # houses and attribute values live in one node space, equal values of
+    # different columns are the same node
+    codes, uniques = pd.factorize(pd.concat([df[hid]] + [df[c] for c in cols], ignore_index=True))
+    codes = codes.astype(np.int64)
+    n_nodes = len(uniques)
+    house = np.tile(codes[:n_houses], len(cols))
+    value = codes[n_houses:]
+    # the graph is undirected, so every edge connects both of its ends
+    edges = np.unique(np.concatenate((house * n_nodes + value, value * n_nodes + house)))
+    src, dst = np.divmod(edges, n_nodes)
+    graph = sparse.csr_matrix((np.ones(len(edges), dtype=np.int32), (src, dst)), shape=(n_nodes, n_nodes))
+    rows = pd.Index(uniques).get_indexer(list(id_list))
+    if (rows < 0).any():
+        raise ValueError('{} ids of id_list are not in the {} column'.format(int((rows < 0).sum()), hid))
+    return graph[rows]
+
+
+def prefix_incidence(incidence, threshold):
+    '''
+    incidence: 0/1 csr matrix of shape (houses, attribute values)
+    threshold: minimum Dice similarity of a pair
+    return: the incidence matrix cut to the rarest values of every house, two
+        houses with a Dice similarity of at least threshold share one of them
+
+    A house with d values needs at least threshold * d / (2 - threshold) common
+    values with any house to reach the threshold, so it can not miss all of its
+    d - ceil(threshold * d / (2 - threshold)) + 1 rarest values (prefix filtering).
+    The very common values (waterfront 0, the largest zipcode) are left out of
+    the inverted index this way.
+    '''
+    incidence = sparse.csr_matrix(incidence)
+    degree = np.diff(incidence.indptr)
+    frequency = np.bincount(incidence.indices, minlength=incidence.shape[1])
+    # rarest value first, equal frequencies by value
+    rank = np.empty(incidence.shape[1], dtype=np.int64)
+    rank[np.lexsort((np.arange(incidence.shape[1]), frequency))] = np.arange(incidence.shape[1])
+    rows = np.repeat(np.arange(incidence.shape[0]), degree)
+    order = np.lexsort((rank[incidence.indices], rows))
+    # position of every value among the values of its house, rarest first
+    position = np.arange(len(order)) - np.repeat(incidence.indptr[:-1], degree)
+    needed = np.ceil(threshold * degree / (2 - threshold) - 1e-9).astype(np.int64)
+    length = np.clip(degree - needed + 1, 0, degree)
+    keep = order[position < np.repeat(length, degree)]
+    keep.sort()
+    return sparse.csr_matrix((np.ones(len(keep), dtype=np.int32), (rows[keep], incidence.indices[keep])),
+                             shape=incidence.shape)
+
+
+def dice_rows(incidence, incidence_t, start, stop, prefix=None, prefix_t=None, threshold=None, top_k=None,
+              dtype=np.float64):
+    '''
+    incidence, incidence_t: 0/1 csr incidence matrix and its transpose
+    prefix, prefix_t: prefix_incidence(incidence, threshold) and its transpose, the
+        candidate pairs are then the pairs sharing a prefix value instead of all
+        pairs sharing any value
+    threshold: only similarities of at least threshold are kept
+    top_k: only the top_k largest similarities of every row are kept, equal
+        similarities by column. The house itself is one of them
+    return: (stop - start, houses) csr matrix of the rows start:stop of the Dice similarity
+    '''
+    n = incidence.shape[0]
+    degree = np.diff(incidence.indptr).astype(np.int64)
+    if prefix is None:
+        # number of shared attribute values for every pair in the block
+        common = (incidence[start:stop] @ incidence_t).tocoo()
+        rows, cols, shared = common.row, common.col, common.data
+    else:
+        candidates = (prefix[start:stop] @ prefix_t).tocoo()
+        rows, cols = candidates.row, candidates.col
+        # number of shared attribute values of the candidate pairs only
+        shared = np.asarray(incidence[start + rows].multiply(incidence[cols]).sum(axis=1)).ravel()
+    similarity = (2.0 * shared / (degree[start + rows] + degree[cols])).astype(dtype)
+    if threshold is not None:
+        keep = similarity >= threshold
+        rows, cols, similarity = rows[keep], cols[keep], similarity[keep]
+    if top_k is not None:
+        order = np.lexsort((cols, -similarity, rows))
+        rows, cols, similarity = rows[order], cols[order], similarity[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < top_k
+        rows, cols, similarity = rows[keep], cols[keep], similarity[keep]
+    return sparse.csr_matrix((similarity, (rows, cols)), shape=(stop - start, n))
+
+
+def dice_adj(incidence, block_size=1024, dtype=np.float64, dense=True, threshold=None, top_k=None):
+    '''
+    incidence: sparse 0/1 matrix of shape (houses, attribute values)
+    block_size: number of rows computed per sparse product, bounds the memory
+        of the intermediate result to block_size * houses entries
+    dense: return a dense array, otherwise a csr matrix of the non zero similarities
+    threshold, top_k: similarity join, see dice_rows. With a threshold only the
+        pairs sharing one of their rarest values are compared
+    return: (houses, houses) Dice similarity matrix
+    '''
+    incidence = sparse.csr_matrix(incidence, dtype=np.int32)
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    n = incidence.shape[0]
+    incidence_t = incidence.T.tocsc()
+    prefix, prefix_t = None, None
+    if threshold is not None and threshold > 0:
+        prefix = prefix_incidence(incidence, threshold)
+        prefix_t = prefix.T.tocsc()
+    adj = np.zeros((n, n), dtype=dtype) if dense else []
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = dice_rows(incidence, incidence_t, start, stop, prefix, prefix_t, threshold, top_k, dtype)
+        if dense:
+            block = block.tocoo()
+            adj[start + block.row, block.col] = block.data
+        else:
+            adj.append(block)
+    if not dense:
+        adj = sparse.vstack(adj, format='csr') if adj else sparse.csr_matrix((0, 0), dtype=dtype)
+    return adj
+
+
+def create_adj(df, id_list, hid='house', block_size=1024, dense=True, threshold=None, top_k=None):
+    '''
+    df: dataframe with the house id column and the meta path attribute columns. A
+        house sold several times has the attributes of its first row
+    id_list: list of ids for which adjacency matrix is to be created
+    hid: name of the house id column
+    dense: return a dense array, otherwise a csr matrix
+    threshold: only keep the similarities of at least threshold
+    top_k: only keep the top_k largest similarities of every house
+    '''
+    return dice_adj(meta_incidence(df, id_list, hid), block_size=block_size, dense=dense,
+                    threshold=threshold, top_k=top_k)
+
+
+def update_adj(adj, id_list, attributes, delta, removed=(), hid='house', block_size=1024):
+    '''
+    Update a Dice adjacency with new sales and delisted houses without
+    recomputing the pairs of houses that did not change.
+
+    adj: (len(id_list), len(id_list)) sparse adjacency built by create_adj, without
+        threshold or top_k
+    id_list: house id of every row of adj, a house sold several times has a row per sale
+    attributes: the dataframe adj was built from, one row per house is used
+    delta: dataframe with the same columns, one row per new sale. Every sale is
+        appended to id_list and a house keeps the attributes of its first sale, as
+        create_adj on the old and the new sales does: a known house keeps its row
+        of attributes, a new house gets its first delta row
+    removed: ids of delisted houses, all their rows and columns are dropped
+    return: (adj, id_list, attributes), adj is the csr matrix that
+        create_adj(attributes, id_list, hid, dense=False) gives
+    '''
+    attributes = attributes.drop_duplicates(subset=[hid], keep='first')
+    delta = delta[attributes.columns]
+    # the house of every new sale, in order
+    sales = list(delta[hid])
+    delta = delta.drop_duplicates(subset=[hid], keep='first')
+    # a delisted house that is in delta again is kept
+    removed = pd.Index(list(removed)).difference(delta[hid])
+    old = attributes.set_index(hid)
+    new = delta.set_index(hid)
+    # houses whose attribute row is new or deleted
+    changed = new.index[~new.index.isin(old.index)]
+    touched = changed.append(removed[removed.isin(old.index)])
+    attributes = pd.concat([old.drop(touched, errors='ignore'), new.loc[changed]]).reset_index()
+
+    old_ids = pd.Index(list(id_list))
+    keep = ~old_ids.isin(removed)
+    id_list = list(old_ids[keep]) + sales
+    # a house id equal to an attribute value is the same graph node, so houses
+    # whose id is a value of a touched house change their neighbours as well
+    values = pd.concat([old.loc[old.index.isin(touched)], new.loc[changed]]).values.ravel()
+    affected = pd.Index(id_list).isin(touched) | pd.Index(id_list).isin(pd.Index(values).dropna())
+    kept = np.flatnonzero(keep)
+    # the rows of the new sales, also of known houses, are all computed
+    affected[len(kept):] = True
+    rows = np.flatnonzero(affected)
+
+    n = len(id_list)
+    adj = sparse.csr_matrix(adj)[kept][:, kept]
+    adj = sparse.bmat([[adj, None], [None, sparse.csr_matrix((n - len(kept), n - len(kept)))]], format='csr')
+    # drop the old similarities of the affected houses
+    mask = sparse.diags((~affected).astype(np.float64))
+    adj = (mask @ adj @ mask).tocsr()
+
+    incidence = sparse.csr_matrix(meta_incidence(attributes, id_list, hid), dtype=np.int32)
+    incidence.data[:] = 1
+    degree = np.diff(incidence.indptr).astype(np.int64)
+    incidence_t = incidence.T.tocsc()
+    blocks = []
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        common = (incidence[block] @ incidence_t).tocoo()
+        den = degree[block[common.row]] + degree[common.col]
+        blocks.append(sparse.csr_matrix((2.0 * common.data / den, (block[common.row], common.col)), shape=(n, n)))
+    fresh = sum(blocks, sparse.csr_matrix((n, n)))
+    # the rows of the affected houses and their mirrored columns, without counting
+    # the pairs of two affected houses twice
+    fresh_t = (sparse.diags((~affected).astype(np.float64)) @ fresh.T).tocsr()
+    adj = (adj + fresh + fresh_t).tocsr()
+    adj.eliminate_zeros()
+    adj.sort_indices()
+    return adj, id_list, attributes
+
+
+def verify_update(sales, delta, removed=(), hid='house', atol=1e-12):
+    '''
+    Regression check of update_adj: builds the adjacency of the old sales, updates
+    it with delta and compares the result with create_adj on the old and the new
+    sales, the full rebuild of adj_luce.py.
+
+    sales: the old sales, one row per sale
+    delta, removed: see update_adj
+    return: the largest absolute difference, a ValueError if it is above atol or
+        the row order differs
+    '''
+    sales = sales.reset_index(drop=True)
+    adj = create_adj(sales, list(sales[hid]), hid, dense=False)
+    updated, id_list, attributes = update_adj(adj, list(sales[hid]), sales, delta, removed, hid)
+    # the new sales after the old ones, without the delisted houses that are not sold again
+    rebuilt_sales = pd.concat([sales, delta[sales.columns]], ignore_index=True)
+    rebuilt_sales = rebuilt_sales[~rebuilt_sales[hid].isin(pd.Index(list(removed)).difference(delta[hid]))]
+    rebuilt_ids = list(rebuilt_sales[hid])
+    if rebuilt_ids != list(id_list):
+        raise ValueError('update_adj gives {} rows, the rebuild {} or in another order'.format(len(id_list), len(rebuilt_ids)))
+    rebuilt = create_adj(rebuilt_sales, rebuilt_ids, hid, dense=False)
+    diff = abs(updated - rebuilt).max() if updated.nnz or rebuilt.nnz else 0.0
+    if diff > atol:
+        raise ValueError('update_adj differs from the rebuild by {}'.format(diff))
+    return diff
+
+
+def haversine_distance(lat1, lon1, lat2, lon2, radius=6371):
+    """
+    Calculate the Haversine distance between two points given their latitude and longitude coordinates.
+    The result is returned in kilometers by default. Works elementwise on arrays.
+    """
+    delta_lat = np.radians(lat2 - lat1)
+    delta_lon = np.radians(lon2 - lon1)
+    a = np.sin(delta_lat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(delta_lon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    distance = radius * c
+    return distance
+
+
+def geo_pairs(lat, lon, cutoff, radius=6371):
+    '''
+    lat, lon: coordinates of the houses in degrees
+    cutoff: maximum haversine distance of a pair in km
+    return: (i, j, distance) of all pairs i < j closer than cutoff
+    '''
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    phi, lam = np.radians(lat), np.radians(lon)
+    # a KD-tree on points of the unit sphere, the chord length grows with the arc length
+    xyz = np.stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)), axis=1)
+    chord = 2 * np.sin(min(cutoff / (2 * radius), np.pi / 2))
+    pairs = cKDTree(xyz).query_pairs(chord * (1 + 1e-9), output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+    dist = haversine_distance(lat[i], lon[i], lat[j], lon[j], radius)
+    keep = dist <= cutoff
+    return i[keep], j[keep], dist[keep]
+
+
+def gaussian_geo_adj(lat, lon, sigma, cutoff=None, dense=False):
+    '''
+    lat, lon: coordinates of the houses in degrees
+    sigma: bandwidth of the gaussian kernel exp(-d^2 / (2 sigma^2)) in km
+    cutoff: pairs further apart than cutoff km are left out, by default 4 sigma
+        where the kernel is already below 4e-4
+    dense: compute every pair into a dense matrix, only for a small number of houses
+    return: row normalized similarity matrix, csr unless dense is set
+    '''
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = len(lat)
+    if dense:
+        distance = haversine_distance(lat[:, np.newaxis], lon[:, np.newaxis], lat[np.newaxis, :], lon[np.newaxis, :])
+        adj = np.exp(- (distance ** 2) / (2 * sigma ** 2))
+        return adj / adj.sum(axis=1, keepdims=True)
+    if cutoff is None:
+        cutoff = 4 * sigma
+    i, j, distance = geo_pairs(lat, lon, cutoff)
+    similarity = np.exp(- (distance ** 2) / (2 * sigma ** 2))
+    diag = np.arange(n)
+    rows = np.concatenate((i, j, diag))
+    cols = np.concatenate((j, i, diag))
+    data = np.concatenate((similarity, similarity, np.ones(n)))
+    adj = sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+    return normalize_rows(adj)
+
+
+def normalize_rows(adj):
+    '''
+    adj: sparse matrix
+    return: csr matrix with every non empty row summing to one
+    '''
+    adj = sparse.csr_matrix(adj, dtype=np.float64)
+    rowsum = np.asarray(adj.sum(axis=1)).flatten()
+    r_inv = np.zeros_like(rowsum)
+    np.divide(1.0, rowsum, out=r_inv, where=rowsum != 0)
+    adj.data *= np.repeat(r_inv, np.diff(adj.indptr))
+    return adj
+
+
+if __name__ == '__main__':
+    # regression cases of update_adj against the full rebuild, small synthetic sales
+    # whose ids 0..99 collide with the attribute values, and shifted so they do not
+    rng = np.random.RandomState(0)
+    for offset in (0, 1000):
+        def sales(ids):
+            return pd.DataFrame({'id': ids, 'grade': rng.randint(3, 8, len(ids)) + offset,
+                                 'waterfront': rng.randint(0, 2, len(ids)) + offset,
+                                 'sqft_living': rng.randint(1000, 1030, len(ids))})
+        old = sales(list(range(100)) + [3, 5, 7, 7])
+        first = old.drop_duplicates(subset=['id']).set_index('id')
+        cases = {'repeat sale': (first.loc[[3, 10]].reset_index(), []),
+                 'repeat sale with changed attributes': (sales([50, 7]), []),
+                 'new house sold twice': (sales([200, 201, 200]), []),
+                 'delisted houses': (sales([]), [7, 8]),
+                 'delisted house sold again': (sales([8, 300]), [8, 9])}
+        for name, (delta, removed) in cases.items():
+            print('offset {}, {}: largest difference {}'.format(offset, name, verify_update(old, delta, removed, 'id')))
@@ -77,6 +77,7 @@ class PDVMConfig(Config):
         self.K = 5 # number of nearest neighbors, preferably odd
         self.year = 'all' # maximum amount of samples in 2016
         self.distance_limit = 2 # maximum distance between two points
+        self.knn_path = 'data/knn/' # cache of the nearest neighbor tables
 
         # Model parameters
         self.input_dim = 338
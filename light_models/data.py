@@ -1,7 +1,11 @@
+import os
+import json
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
+from scipy.spatial import cKDTree
 from mlxtend.feature_selection import SequentialFeatureSelector
 from sklearn.decomposition import PCA
 from sklearn.linear_model import LogisticRegression
@@ -49,27 +53,39 @@ class DNN_Dataset(Dataset):
 
     
 class KNSHS_Dataset(Dataset):
-    def __init__(self, input, output, lon, lat, K, distance_limit):
+    def __init__(self, input, output, lon, lat, K, distance_limit, cache_path=None):
         self.output = output
-        self.knn = KNSHS(input, lon, lat, K, distance_limit)
+        self.knn = KNSHS(input, lon, lat, K, distance_limit, cache_path)
 
     def __len__(self):
         return len(self.output)
 
     def __getitem__(self, idx):
-        x = self.knn.apply_knn(idx).transpose(1,0)
-        y = self.output[idx]
-        x = torch.tensor(x, dtype=torch.float)
-        y = torch.tensor(y, dtype=torch.float)
-        return x, y
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, idxs):
+        # the neighbor stacks of a whole batch are gathered at once
+        x = torch.tensor(self.knn.gather(idxs), dtype=torch.float)
+        y = torch.tensor(np.asarray(self.output)[idxs], dtype=torch.float)
+        return list(zip(x, y))
 
 class KNSHS:
-    def __init__(self, input, lon, lat, K, distance_limit):
+    def __init__(self, input, lon, lat, K, distance_limit, cache_path=None):
+        '''
+        The K-1 nearest neighbors within distance_limit of every house are found
+        once with a KD-tree and kept as an int32 table, with the house itself in the
+        first column and -1 where there are fewer neighbors. With cache_path the
+        table is stored as knn_<fingerprint>.npy and memory mapped, the fingerprint
+        hashes the coordinates, K and distance_limit.
+        '''
         self.K = K
         self.input = input
-        self.lon = lon
-        self.lat = lat
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
         self.distance_limit = distance_limit
+        # row -1 of the padded input is the padding column
+        self.padded = np.concatenate((np.asarray(input), -np.ones((1, np.shape(input)[1]))), axis=0)
+        self.neighbors = self.load_neighbors(cache_path)
     
     def distance(self, lon1, lat1, lon2, lat2):
         # lon1, lat1: longitude and latitude of the first point
@@ -83,29 +99,81 @@ class KNSHS:
         c = 2 * np.arcsin(np.sqrt(a))
         d = R * c
         return d
-    
-    def apply_knn(self, idx):
-        # x: input data
-        # K: number of nearest neighbors
-        # return: x with K nearest neighbors
-        closest = []
-        for i in range(len(self.input)):
-            if i == idx:
-                continue
-            dist = self.distance(self.lon[idx], self.lat[idx], self.lon[i], self.lat[i])
-            if dist <= self.distance_limit:
-                closest.append((i, dist))
-        closest.sort(key=lambda x: x[1])
-        closest = closest[:self.K-1]
-
-        x = np.expand_dims(self.input[idx], axis=1)
-        for i in range(len(closest)):
-            x = np.append(x, np.expand_dims(self.input[closest[i][0]], axis=1), axis=1)
-        if x.shape[1] < self.K:
-            x = np.append(x, (-1)*np.ones((x.shape[0], self.K - x.shape[1])), axis=1)
+
+    def fingerprint(self):
+        h = hashlib.sha1()
+        h.update(self.lon.tobytes())
+        h.update(self.lat.tobytes())
+        h.update(json.dumps([self.K, self.distance_limit]).encode())
+        return h.hexdigest()
+
+    def load_neighbors(self, cache_path=None):
+        if cache_path is None:
+            return self.build_neighbors()
+        path = os.path.join(cache_path, 'knn_{}.npy'.format(self.fingerprint()))
+        if not os.path.exists(path):
+            if not os.path.isdir(cache_path):
+                os.makedirs(cache_path)
+            # written to a temporary file first so that a killed run leaves no partial table
+            tmp = path + '.tmp{}.npy'.format(os.getpid())
+            np.save(tmp, self.build_neighbors())
+            os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+
+    def build_neighbors(self):
+        # return: (N, K) int32 table, the house, its K-1 nearest neighbors within
+        # distance_limit sorted by distance and index, and -1 padding
+        n, k = len(self.lon), self.K - 1
+        table = -np.ones((n, self.K), dtype=np.int32)
+        table[:, 0] = np.arange(n)
+        if n < 2 or k < 1:
+            return table
+        phi, lam = np.radians(self.lat), np.radians(self.lon)
+        xyz = np.stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)), axis=1)
+        tree = cKDTree(xyz)
+        # chord length of distance_limit on the unit sphere
+        limit = 2 * np.sin(min(self.distance_limit / (2 * 6371), np.pi / 2)) * (1 + 1e-9)
+        # one candidate more than the neighbors and the house itself shows ties at the k-th neighbor
+        chords, cand = tree.query(xyz, k=min(k + 2, n), distance_upper_bound=limit)
+        chords, cand = chords.reshape(n, -1), cand.reshape(n, -1)
+        valid = (cand < n) & (cand != np.arange(n)[:, np.newaxis])
+        cand = np.where(valid, cand, n)
+        dist = self.distance(self.lon[:, np.newaxis], self.lat[:, np.newaxis],
+                             self.lon[np.minimum(cand, n - 1)], self.lat[np.minimum(cand, n - 1)])
+        dist[~valid | (dist > self.distance_limit)] = np.inf
+        order = np.lexsort((cand, dist), axis=1)[:, :k]
+        best = np.take_along_axis(cand, order, axis=1)
+        best_dist = np.take_along_axis(dist, order, axis=1)
+        best_chord = np.take_along_axis(chords, order, axis=1)
+        table[:, 1:1 + best.shape[1]] = np.where(np.isfinite(best_dist), best, -1)
+        # when every candidate was returned, a house that was not returned can be
+        # closer than the limit or tie with the k-th neighbor, e.g. many houses of one
+        # complex on the same coordinates. These houses are solved on all the houses
+        # within the tied distance so that the lowest indexes are kept like before
+        count = np.isfinite(best_dist).sum(axis=1)
+        full = np.isfinite(chords[:, -1])
+        tied = np.flatnonzero(full & ((count < k) | (best_chord[:, -1] >= chords[:, -1] * (1 - 1e-9))))
+        for i in tied:
+            radius = limit if count[i] < k else chords[i, -1] * (1 + 1e-9)
+            ball = np.asarray(tree.query_ball_point(xyz[i], radius), dtype=np.int64)
+            ball = ball[ball != i]
+            d = self.distance(self.lon[i], self.lat[i], self.lon[ball], self.lat[ball])
+            ball, d = ball[d <= self.distance_limit], d[d <= self.distance_limit]
+            nearest = ball[np.lexsort((ball, d))][:k]
+            table[i, 1:] = -1
+            table[i, 1:1 + len(nearest)] = nearest
+        return table
+
+    def gather(self, idxs):
+        # idxs: indexes of the houses
+        # return: (len(idxs), K, features) stacks of the houses and their neighbors
+        x = self.padded[np.asarray(self.neighbors)[np.asarray(idxs)]]
         # put the input data at the center of the array
-        # flipping is for better feature extraction
-        x = np.append(np.flip(x[:, self.K//2+2:]), x[:, :self.K//2+2], axis=1)
-        #print(sum(x[:, self.K//2+1]==0))
-        #exit()
+        # flipping is for better feature extraction, like np.flip of each (features, K) stack
+        c = self.K//2+2
+        x = np.concatenate((x[:, c:][:, ::-1, ::-1], x[:, :c]), axis=1)
         return x
+
+    def apply_knn(self, idx):
+        # return: the (features, K) stack of house idx
+        return self.gather([idx])[0].transpose(1, 0)
@@ -1,4 +1,6 @@
+import os
 from tensorboardX import SummaryWriter
+from run_log import RunLog
 
 class Logger():
     def __init__(self, save_name = None) -> None:
@@ -6,9 +8,12 @@ class Logger():
             self.logger = SummaryWriter(logdir='runs/{}'.format(save_name))
         else:
             self.logger = SummaryWriter()
+        # the same values as json lines next to the tensorboard events
+        self.run = RunLog(os.path.join(self.logger.logdir, 'run.jsonl'))
 
     # TODO: Add more methods to log training and validation metrics
     def log_training(self, loss, metrics, epoch):
+        self.run.log('train', epoch, loss=loss, metrics=list(metrics))
         self.logger.add_scalars('loss',{
                 'trainiing_loss': loss
             }, epoch)
@@ -18,6 +23,7 @@ class Logger():
             }, epoch)
 
     def log_validation(self, loss, metrics, epoch):
+        self.run.log('valid', epoch, loss=loss, metrics=list(metrics))
         self.logger.add_scalars('loss',{
                 'validation_loss': loss,
             }, epoch)
@@ -27,4 +33,5 @@ class Logger():
             }, epoch)
     
     def close(self):
-        self.logger.close()
\ No newline at end of file
+        self.logger.close()
+        self.run.close()
\ No newline at end of file
@@ -50,7 +50,7 @@ if __name__ == '__main__':
     df = df.values.astype(np.float32)
 
     # Prepare data for training
-    dataset = KNSHS_Dataset(df, prices, lons, lats, config.K, config.distance_limit)
+    dataset = KNSHS_Dataset(df, prices, lons, lats, config.K, config.distance_limit, config.knn_path)
     train_size = int(config.train_ratio*len(dataset))
     valid_size = len(dataset) - train_size 
     train_dataset, valid_dataset = random_split(dataset, [train_size, valid_size])
@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from adj_store import load_adjacency, SparseAdjacency, BatchGraphs
 import torch.nn as nn
 from model_gtn import GTN, GCN
 from model_fastgtn import FastGTNs
@@ -14,7 +15,10 @@ import copy
 import pandas as pd
 #from sklearn.externals import joblib 
 import joblib
+from metrics import PriceScaler, PriceMetrics
+from run_log import RunLog
 import os
+import time
 
 
 if __name__ == '__main__':
@@ -66,15 +70,13 @@ if __name__ == '__main__':
     num_layers = args.num_layers
 
     A = []
-    adj_matrix = np.load('data/{}.npy'.format("adjacency_luce"))
-    adj_matrix = np.expand_dims(adj_matrix, axis=0)
-    
-    adj_matrix1 = np.load('data/{}.npy'.format("adj_goe"))
-    adj_matrix1 = np.expand_dims(adj_matrix1, axis=0)
+    # sparse containers, or the older dense .npy / .npz files of the same name.
+    # they stay memory-mapped, every batch only reads its own rows
+    adj_matrix = load_adjacency('data/{}'.format("adjacency_luce"), mmap_mode='r')
+    adj_matrix1 = load_adjacency('data/{}'.format("adj_goe"), mmap_mode='r')
     #print(adj_matrix1.shape, adj_matrix.shape)
-    adj_matrix = adj_matrix[:,:adj_matrix1.shape[1],:adj_matrix1.shape[2]]
-    # concatenate two adjacency matrix
-    adj_matrix = np.concatenate((adj_matrix, adj_matrix1), axis=0)
+    # concatenate two adjacency matrix, truncated to the houses of the geo adjacency
+    adj_matrix = SparseAdjacency.concat([adj_matrix, adj_matrix1], num_nodes=adj_matrix1.num_nodes)
     
 
     num_nodes = adj_matrix.shape[1]
@@ -91,6 +93,8 @@ if __name__ == '__main__':
     result_path = './result/'
     if not os.path.exists(result_path):
         os.makedirs(result_path)
+    # metrics of every epoch, buffered and appended to one file
+    run_log = RunLog(result_path + 'run.jsonl')
     
     node_features = np.load('data/{}.npy'.format("X_train"))
 
@@ -139,6 +143,8 @@ if __name__ == '__main__':
         if args.pre_train and l > 0:
             for layer in range(args.num_FastGTN_layers):
                 model.fastGTNs[layer].layers = pre_trained_fastGTNs[layer]
+    # inverse of the price scaling, saved with the checkpoints of the model
+    model.price_scaler = PriceScaler.from_sklearn(joblib.load('./data/scaler_price.pkl'))
 
     train_features = np.load('data/{}.npy'.format("X_train"))
     train_features = train_features
@@ -155,6 +161,10 @@ if __name__ == '__main__':
 
     train_node_features = torch.from_numpy(train_features).type(torch.FloatTensor).to(device)
     valid_node_features = torch.from_numpy(valid_features).type(torch.FloatTensor).to(device)
+    # subgraphs of the batches, built once instead of in every epoch
+    train_graphs = BatchGraphs.induced(adj_matrix, 0, len(train_node_features), args.batch_size, device)
+    valid_graphs = BatchGraphs.induced(adj_matrix, len(train_node_features),
+                                       len(train_node_features) + len(valid_node_features), args.batch_size, device)
 
     for cur_month in range(1, seq_len+1):
         # pre-training model parameter loading
@@ -211,22 +221,14 @@ if __name__ == '__main__':
 
         model.to(device)
         #model = nn.DataParallel(model)
-        calc_loss = nn.MSELoss()#nn.L1Loss()
         Ws = []
-        scaler = joblib.load('./data/scaler_price.pkl')
+        train_metrics = PriceMetrics(model.price_scaler)
+        valid_metrics = PriceMetrics(model.price_scaler)
         for epoch in range(epochs):
             # print('Epoch ',i)
-            avg_train_loss = 0
-            avg_valid_loss = 0
-            avg_test_loss = 0
-            avg_train_mape_error = 0
-            avg_valid_mape_error = 0
-            avg_test_mape_error = 0
-            avg_train_mse_error = 0
-            avg_valid_mse_error = 0
-            avg_test_mse_error = 0
-            avg_train_mae_error = 0
-            avg_valid_mae_error = 0
+            train_metrics.reset()
+            valid_metrics.reset()
+            start_time = time.time()
             model.train()
             for batch in range(0, len(train_node_features), args.batch_size):
                 batch_size = min(args.batch_size, len(train_node_features)-batch)
@@ -252,12 +254,8 @@ if __name__ == '__main__':
                     #print(edge_index.shape, edge_weight.shape)
                     a.append((edge_index.to(device), edge_weight.to(device)))           
                 '''
-                A = adj_matrix[:,batch:batch+batch_size,batch:batch+batch_size]
-                edge_index = torch.from_numpy(np.vstack(A.nonzero())).to(torch.long)
-                edge_weight = torch.from_numpy(A[A.nonzero()]).to(torch.float32)
-                #print(edge_index.shape, edge_weight.shape)
-                a.append((edge_index.to(device), edge_weight.to(device)))  
-                num_nodes = edge_index.shape[1]              
+                a = train_graphs[batch]
+                num_nodes = a[0][0].shape[1]
                 
                 if args.model == 'FastGTN':
                     loss,train_mse,y_train,W = model(a, train_node_features[batch:batch+batch_size], train_target[batch:batch+batch_size], num_nodes=num_nodes, epoch=epoch)
@@ -265,37 +263,18 @@ if __name__ == '__main__':
                     loss,train_mse,y_train,W = model(a, train_node_features[batch:batch+batch_size], train_target[batch:batch+batch_size], num_nodes=num_nodes)
                 loss.backward()
                 optimizer.step()
-                y_transform = scaler.inverse_transform(y_train.detach().cpu().numpy().reshape(-1,1))
-                y_origin = scaler.inverse_transform(train_target[batch:batch+batch_size].detach().cpu().numpy().reshape(-1,1))
-                mape = np.mean(np.abs((y_transform - y_origin) / y_origin))*100
-                mae_error = np.mean(np.abs(y_transform - y_origin))
-                # make them tensors
-                y_transform = torch.from_numpy(y_transform).to(device)
-                y_origin = torch.from_numpy(y_origin).to(device)
-                # calculate the mse loss using the original data
-                loss = calc_loss(y_transform, y_origin)
-                rmse_error = np.sqrt(loss.detach().cpu().numpy())
-                
-                avg_train_loss += loss.detach().cpu().numpy() / num_batches
-                avg_train_mse_error += rmse_error / num_batches
-                avg_train_mae_error += mae_error / num_batches
-                # calculate MAPE score as well
-                #mape = np.mean(np.abs((y_train.detach().cpu().numpy() - train_target[batch:batch+batch_size].detach().cpu().numpy()) / train_target[batch:batch+batch_size].detach().cpu().numpy()))*100
-                avg_train_mape_error += mape / num_batches
+                # errors in prices, summed on the device
+                train_metrics.update(y_train, train_target[batch:batch+batch_size])
             
+            train = train_metrics.compute()
+            avg_train_loss, avg_train_mse_error = train['mse'], train['rmse']
+            avg_train_mae_error, avg_train_mape_error = train['mae'], train['mape']
             print('Epoch: {}\n Train - Loss: {}\n Train - RMSE: {}\n Train - MAE: {}\n Train - MAPE: {}\n'.format(epoch, avg_train_loss, avg_train_mse_error, avg_train_mae_error, avg_train_mape_error))
-            # write the training loss to the file
-            with open(result_path + 'train_loss.txt', 'a') as f:
-                f.write(str(avg_train_loss) + '\n')
-            with open(result_path + 'train_rmse.txt', 'a') as f:
-                f.write(str(avg_train_mse_error) + '\n')
-            with open(result_path + 'train_mape.txt', 'a') as f:
-                f.write(str(avg_train_mape_error) + '\n')
-            with open(result_path + 'train_mae.txt', 'a') as f:
-                f.write(str(avg_train_mae_error) + '\n')
+            run_log.log('train', epoch, month=cur_month, seconds=time.time() - start_time, **train)
             
             scheduler.step()
             # validation
+            start_time = time.time()
             model.eval()
             val_pred, val_tar = None, None
             for batch in range(0, len(valid_node_features), args.batch_size):
@@ -317,65 +296,37 @@ if __name__ == '__main__':
                     edge_weight = torch.from_numpy(A[A.nonzero()]).to(torch.float32)
                     a.append((edge_index.to(device), edge_weight.to(device)))
                 '''
-                A = adj_matrix[:,len(train_node_features)+batch:len(train_node_features)+batch+batch_size,len(train_node_features)+batch:len(train_node_features)+batch+batch_size]
-                edge_index = torch.from_numpy(np.vstack(A.nonzero())).to(torch.long)
-                edge_weight = torch.from_numpy(A[A.nonzero()]).to(torch.float32)
-                #print(edge_index.shape, edge_weight.shape)
-                a.append((edge_index.to(device), edge_weight.to(device)))  
-                num_nodes = edge_index.shape[1]         
+                a = valid_graphs[batch]
+                num_nodes = a[0][0].shape[1]
                 with torch.no_grad():
                     if args.model == 'FastGTN':
                         val_loss, val_mse, y_valid,_ = model.forward(a, valid_node_features[batch:batch+batch_size], valid_target[batch:batch+batch_size], num_nodes=num_nodes, epoch=epoch)
                     else:
                         val_loss, val_mse, y_valid,_ = model.forward(a, valid_node_features[batch:batch+batch_size], valid_target[batch:batch+batch_size], num_nodes=num_nodes)
-                y_transform = scaler.inverse_transform(y_valid.detach().cpu().numpy().reshape(-1,1))
-                y_origin = scaler.inverse_transform(valid_target[batch:batch+batch_size].detach().cpu().numpy().reshape(-1,1))
-                mape = np.mean(np.abs((y_transform - y_origin) / y_origin))*100
-                mae_error = np.mean(np.abs(y_transform - y_origin))
-                
-                y_transform = torch.from_numpy(y_transform).to(device)
-                y_origin = torch.from_numpy(y_origin).to(device)
-                val_loss = calc_loss(y_origin, y_transform)
-                val_rmse_error = np.sqrt(val_loss.detach().cpu().numpy())
-                avg_valid_loss += val_loss.detach().cpu().numpy() / num_batches
-                avg_valid_mse_error += val_rmse_error / num_batches
-                avg_valid_mae_error += mae_error / num_batches
-                # calculate MAPE score as well
-                #mape = np.mean(np.abs((y_valid.detach().cpu().numpy() - valid_target[batch:batch+batch_size].detach().cpu().numpy()) / valid_target[batch:batch+batch_size].detach().cpu().numpy()))*100
-                
-                avg_valid_mape_error += mape / num_batches
+                valid_metrics.update(y_valid, valid_target[batch:batch+batch_size])
                                 
                 if epoch % (epochs-1) == 0:
-                    y_target = valid_target[batch:batch+batch_size]
-                    y_target = y_target.detach().cpu().numpy()
-                    y_valid = y_valid.detach().cpu().numpy()
-                    
-                    #print(y_valid.shape, y_target.shape)
-                    val_predict = scaler.inverse_transform(y_valid)
-                    val_target = scaler.inverse_transform(y_target)
+                    # kept on the device, copied once after the last batch
+                    val_predict = model.price_scaler(y_valid.detach()).float()
+                    val_target = model.price_scaler(valid_target[batch:batch+batch_size]).float()
                     # concatenate the val_pred and val_tar
                     if val_pred is None:
-                        val_pred = val_predict
-                        val_tar = val_target
+                        val_pred = [val_predict]
+                        val_tar = [val_target]
                     else:
-                        val_pred = np.concatenate((val_pred, val_predict), axis=0)
-                        val_tar = np.concatenate((val_tar, val_target), axis=0)
+                        val_pred.append(val_predict)
+                        val_tar.append(val_target)
 
             if val_pred is not None:
-                np.save(result_path + 'pred_time' + str(cur_month) + '_epoch' + str(epoch) + '.npy', val_pred)
-                np.save(result_path + 'target_time' + str(cur_month) + '_epoch' + str(epoch) + '.npy', val_tar)
+                np.save(result_path + 'pred_time' + str(cur_month) + '_epoch' + str(epoch) + '.npy', torch.cat(val_pred).cpu().numpy())
+                np.save(result_path + 'target_time' + str(cur_month) + '_epoch' + str(epoch) + '.npy', torch.cat(val_tar).cpu().numpy())
                 del val_pred, val_tar
             
+            valid = valid_metrics.compute()
+            avg_valid_loss, avg_valid_mse_error = valid['mse'], valid['rmse']
+            avg_valid_mae_error, avg_valid_mape_error = valid['mae'], valid['mape']
             print('Epoch: {}\n Valid - Loss: {}\n Valid - RMSE: {}\n Valid - MAE: {}\n Valid - MAPE: {}\n'.format(epoch, avg_valid_loss, avg_valid_mse_error, avg_valid_mae_error, avg_valid_mape_error))
-            # log the validation loss
-            with open(result_path + 'valid_loss.txt', 'a') as f:
-                f.write(str(avg_valid_loss) + '\n')
-            with open(result_path + 'valid_rmse.txt', 'a') as f:
-                f.write(str(avg_valid_mse_error) + '\n')
-            with open(result_path + 'valid_mape.txt', 'a') as f:
-                f.write(str(avg_valid_mape_error) + '\n')
-            with open(result_path + 'valid_mae.txt', 'a') as f:
-                f.write(str(avg_valid_mae_error) + '\n')
+            run_log.log('valid', epoch, month=cur_month, seconds=time.time() - start_time, **valid)
                 
         # save the model
         torch.save(model.state_dict(), result_path + 'time' + str(cur_month) + '.pkl')
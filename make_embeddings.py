@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from adj_store import load_adjacency, SparseAdjacency, BatchGraphs
 import torch.nn as nn
 from model_gtn import GTN, GCN
 from model_fastgtn import FastGTNs
@@ -14,6 +15,7 @@ import copy
 import pandas as pd
 #from sklearn.externals import joblib 
 import joblib
+from metrics import PriceScaler
 import os
 
 
@@ -66,15 +68,13 @@ if __name__ == '__main__':
     num_layers = args.num_layers
 
     A = []
-    adj_matrix = np.load('data/{}.npy'.format("adjacency_luce"))
-    adj_matrix = np.expand_dims(adj_matrix, axis=0)
-    
-    adj_matrix1 = np.load('data/{}.npy'.format("adj_goe"))
-    adj_matrix1 = np.expand_dims(adj_matrix1, axis=0)
+    # sparse containers, or the older dense .npy / .npz files of the same name.
+    # they stay memory-mapped, every batch only reads its own rows
+    adj_matrix = load_adjacency('data/{}'.format("adjacency_luce"), mmap_mode='r')
+    adj_matrix1 = load_adjacency('data/{}'.format("adj_goe"), mmap_mode='r')
     #print(adj_matrix1.shape, adj_matrix.shape)
-    adj_matrix = adj_matrix[:,:adj_matrix1.shape[1],:adj_matrix1.shape[2]]
-    # concatenate two adjacency matrix
-    adj_matrix = np.concatenate((adj_matrix, adj_matrix1), axis=0)
+    # concatenate two adjacency matrix, truncated to the houses of the geo adjacency
+    adj_matrix = SparseAdjacency.concat([adj_matrix, adj_matrix1], num_nodes=adj_matrix1.num_nodes)
     
 
     num_nodes = adj_matrix.shape[1]
@@ -127,6 +127,9 @@ if __name__ == '__main__':
 
     # load pre-trained model
     chpt = torch.load(args.pretrained_path)
+    if 'price_scaler.scale' in chpt:
+        # checkpoints of main_prelifelong.py carry the price scaler
+        model.price_scaler = PriceScaler()
     model.load_state_dict(chpt)
 
     train_features = np.load('data/{}.npy'.format("X_train"))
@@ -144,6 +147,10 @@ if __name__ == '__main__':
 
     train_node_features = torch.from_numpy(train_features).type(torch.FloatTensor).to(device)
     valid_node_features = torch.from_numpy(valid_features).type(torch.FloatTensor).to(device)
+    # subgraphs of the batches, built once for the train and valid passes
+    train_graphs = BatchGraphs.induced(adj_matrix, 0, len(train_node_features), args.batch_size, device)
+    valid_graphs = BatchGraphs.induced(adj_matrix, len(train_node_features),
+                                       len(train_node_features) + len(valid_node_features), args.batch_size, device)
 
 
     gamma = args.lr_decay
@@ -157,14 +164,8 @@ if __name__ == '__main__':
         batch_size = min(args.batch_size, len(train_node_features)-batch)
         num_batches = len(train_node_features)//batch_size
         # take a batch of adjecency matrix
-        a = []
-
-        A = adj_matrix[:,batch:batch+batch_size, batch:batch+batch_size]
-        edge_index = torch.from_numpy(np.vstack(A.nonzero())).to(torch.long)
-        edge_weight = torch.from_numpy(A[A.nonzero()]).to(torch.float32)
-        #print(edge_index.shape, edge_weight.shape)
-        a.append((edge_index.to(device), edge_weight.to(device)))  
-        num_nodes = edge_index.shape[1]         
+        a = train_graphs[batch]
+        num_nodes = a[0][0].shape[1]
         with torch.no_grad():
             emb, _ = model.make_embedding(a, train_node_features[batch:batch+batch_size], train_target[batch:batch+batch_size], num_nodes=num_nodes)
         if embs is None:
@@ -179,14 +180,8 @@ if __name__ == '__main__':
         batch_size = min(args.batch_size, len(valid_node_features)-batch)
         num_batches = len(valid_node_features)//batch_size
         # take a batch of adjecency matrix
-        a = []
-
-        A = adj_matrix[:,len(train_node_features)+batch:len(train_node_features)+batch+batch_size,len(train_node_features)+batch:len(train_node_features)+batch+batch_size]
-        edge_index = torch.from_numpy(np.vstack(A.nonzero())).to(torch.long)
-        edge_weight = torch.from_numpy(A[A.nonzero()]).to(torch.float32)
-        #print(edge_index.shape, edge_weight.shape)
-        a.append((edge_index.to(device), edge_weight.to(device)))  
-        num_nodes = edge_index.shape[1]         
+        a = valid_graphs[batch]
+        num_nodes = a[0][0].shape[1]
         with torch.no_grad():
             emb, _ = model.make_embedding(a, valid_node_features[batch:batch+batch_size], valid_target[batch:batch+batch_size], num_nodes=num_nodes)
         if embs is None:
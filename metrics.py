@@ -0,0 +1,77 @@
+import math
+import torch
+import torch.nn as nn
+
+
+"""
+Errors of the predicted prices in the original price units, on the device.
+
+PriceScaler is the inverse of the sklearn MinMaxScaler of the prices
+(data/scaler_price.pkl) as a torch module, so its parameters are buffers saved
+in the state dict of the model it is attached to. PriceMetrics sums the squared,
+absolute and relative errors of every batch on the device, so an epoch needs
+one copy to the host instead of a copy and an sklearn call per batch, and the
+epoch errors are the errors of all rows instead of the mean of the batch means.
+"""
+
+
+class PriceScaler(nn.Module):
+    def __init__(self, scale=None, min_=None):
+        '''
+        scale, min_: scale_ and min_ of the MinMaxScaler, x_scaled = x * scale + min_
+        '''
+        super(PriceScaler, self).__init__()
+        scale = torch.ones(1) if scale is None else torch.as_tensor(scale)
+        min_ = torch.zeros(1) if min_ is None else torch.as_tensor(min_)
+        # float64 like sklearn, prices lose cents in float32
+        self.register_buffer('scale', scale.to(torch.float64).reshape(-1))
+        self.register_buffer('min', min_.to(torch.float64).reshape(-1))
+
+    @classmethod
+    def from_sklearn(cls, scaler):
+        return cls(scaler.scale_, scaler.min_)
+
+    def forward(self, x):
+        '''
+        x: scaled prices, (N, 1) or (N,)
+        return: prices, the float64 result of scaler.inverse_transform
+        '''
+        return (x.to(self.scale.dtype) - self.min) / self.scale
+
+    def transform(self, x):
+        return x.to(self.scale.dtype) * self.scale + self.min
+
+
+class PriceMetrics:
+    def __init__(self, scaler):
+        '''
+        scaler: PriceScaler of the targets
+        '''
+        self.scaler = scaler
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, pred, target):
+        '''
+        pred, target: scaled prices of a batch
+        '''
+        y = self.scaler(pred.detach().reshape(-1))
+        t = self.scaler(target.detach().reshape(-1))
+        err = y - t
+        sums = torch.stack((err.pow(2).sum(), err.abs().sum(), (err / t).abs().sum()))
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.count += err.numel()
+
+    def compute(self):
+        '''
+        return: dict of the mse, rmse, mae and mape (in percent) of the rows seen since reset
+        '''
+        if self.count == 0:
+            return {'mse': float('nan'), 'rmse': float('nan'), 'mae': float('nan'), 'mape': float('nan')}
+        sq, ab, ap = self.sums.tolist()
+        mse = sq / self.count
+        return {'mse': mse, 'rmse': math.sqrt(mse), 'mae': ab / self.count, 'mape': ap / self.count * 100}
@@ -3,6 +3,8 @@ from time import time
 import numpy as np
 import pandas as pd
 from scipy import sparse
+from adjacency import gaussian_geo_adj
+from adj_build import build_geo
 import matplotlib.pyplot as plt
 import argparse
 from sklearn.decomposition import PCA
@@ -11,30 +13,14 @@ from sklearn.preprocessing import MinMaxScaler, StandardScaler
 import joblib
 
 
-def haversine_distance(lat1, lon1, lat2, lon2, radius=6371):
-    """
-    Calculate the Haversine distance between two points given their latitude and longitude coordinates.
-    The result is returned in kilometers by default.
-    """
-    delta_lat = np.radians(lat2 - lat1)
-    delta_lon = np.radians(lon2 - lon1)
-    a = np.sin(delta_lat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(delta_lon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    distance = radius * c
-    return distance
-
-def calculate_gaussian_similarity(data, sigma):
-    n = len(data)
-    similarity_matrix = np.zeros((n, n))
-    for i in range(n):
-        for j in range(i, n):
-            distance = haversine_distance(data['lat'][i], data['long'][i], data['lat'][j], data['long'][j])
-            similarity = np.exp(- (distance ** 2) / (2 * sigma ** 2))
-            similarity_matrix[i][j] = similarity
-            similarity_matrix[j][i] = similarity
-    # normalize the similarity matrix
-    similarity_matrix = similarity_matrix / similarity_matrix.sum(axis=1, keepdims=True)
-    return similarity_matrix
+def calculate_gaussian_similarity(data, sigma, cutoff=None, dense=False):
+    '''
+    data: dataframe with lat and long columns
+    sigma: bandwidth of the gaussian kernel in km
+    cutoff: only pairs closer than cutoff km are kept, see gaussian_geo_adj
+    dense: evaluate all pairs into a dense matrix, to compare with the sparse output for small data
+    '''
+    return gaussian_geo_adj(data['lat'].values, data['long'].values, sigma, cutoff=cutoff, dense=dense)
 
 
 def geo_adj(distance, id_list):
@@ -82,6 +68,9 @@ if __name__ == '__main__':
     parser.add_argument("--data_path" , type=str, default='./data/kc.csv')
     parser.add_argument("--create_adj", type=int, default=1)
     parser.add_argument("--sigma", type=float, default=0.4)
+    parser.add_argument("--cutoff", type=float, default=None, help="maximum distance in km of similar houses, 4 sigma by default")
+    parser.add_argument("--dense", type=int, default=0, help="compute all pairs into a dense matrix (small data only)")
+    parser.add_argument("--processes", type=int, default=1, help="number of processes building the sparse adjacency")
     args = parser.parse_args()
 
     data = pd.read_csv(args.data_path)
@@ -99,10 +88,14 @@ if __name__ == '__main__':
     data = data.drop('id', axis=1)
     if args.create_adj:
         print(data.columns)
-        # create the adjacency matrix
-        adj = calculate_gaussian_similarity(data, args.sigma)
-        # save the adjacency matrix
-        np.save('./data/adj_goe.npy', adj)
+        # create and save the adjacency matrix
+        if args.dense:
+            adj = calculate_gaussian_similarity(data, args.sigma, cutoff=args.cutoff, dense=True)
+            np.save('./data/adj_goe.npy', adj)
+        else:
+            # row blocks in a process pool, an interrupted build resumes from its saved blocks
+            build_geo('./data/adj_goe', data['lat'].values, data['long'].values, args.sigma, cutoff=args.cutoff,
+                      names=['geo'], processes=args.processes)
     # convert the dataframe to numpy array X and y
     y = data['price'].values
     X = data.drop('price', axis=1).values